@@ -24,7 +24,7 @@ def eval_core(raw_data, sts_gt, sts_ev, metric_cls, log=sys.stdout, **kwargs):
     data, ground truth spike train and estimated spike train. As this is a
     core functionality it only log on error.
 
-    :type raw_data: ndarray
+    :type raw_data: ndarray or RawData
     :param raw_data: raw data as ndarray with [samples, channels]
     :type sts_gt: dict
     :param sts_gt: ground truth spike train set
@@ -6,76 +6,367 @@
 # 2009-05-16
 #
 
-"""reading spike trains from GDF and raw data from HDF5"""
+"""reading spike trains from GDF and binary archives and raw data from HDF5
+and flat binary files"""
 __docformat__ = 'restructuredtext'
-__all__ = ['read_gdf_sts', 'read_hdf5_arc', 'create_hdf5_arc', 'create_gdf']
+__all__ = ['DatRawData', 'HDF5RawData', 'read_gdf_sts', 'iter_gdf_sts',
+           'iter_gdf_blocks', 'read_dat_arc', 'read_hdf5_arc',
+           'create_hdf5_arc', 'create_gdf', 'read_sts_arc', 'create_sts_arc',
+           'gdf_to_sts_arc', 'sts_arc_to_gdf']
 
+import os
+import struct
+import zipfile
 import scipy as sp
-from tables import openFile
-from util import dict_arrsort, dict_list2arr, sortrows
+from numpy.lib import format as npy_format
+from tables import Filters, Float32Atom, openFile
+from util import RawData, SpikeTrainSet, sortrows
 
+GDF_BLOCK_SIZE = 2 ** 24
+HDF5_CHUNK_BYTES = 2 ** 18
+STS_ARC_NAMES = ['keys', 'offsets', 'times']
+_POW10 = 10 ** sp.arange(19, dtype=sp.int64)
 
-def read_gdf_sts(file_name):
+
+def read_gdf_sts(file_name, as_set=False, block_size=GDF_BLOCK_SIZE):
     """reads a .gdf file and returns contents, mapping unit id to spike train
 
+    The file is parsed in blocks, see :iter_gdf_blocks:, and the spikes are
+    grouped by unit with one sort over all spikes. Lines that do not have
+    exactly two tokens are skipped, unit ids are kept as strings.
+
     :type file_name: str
     :param file_name: path to the file to read
+    :type as_set: bool
+    :param as_set: if True, return a :SpikeTrainSet:, which holds all spike
+        times in one array with CSR style unit offsets, ordered by unit id
+        Default=False
+    :type block_size: int
+    :param block_size: number of bytes to parse at once
 
     :returns: dict -- dict mapping unit id to the corresponding spike train
     """
 
-    rval = {}
-    with open(file_name, 'r') as arc:
-        for line in arc:
-            data = line.strip().split()
-            if len(data) != 2:
-                continue
-            if data[0] not in rval:
-                rval[data[0]] = []
-            rval[data[0]].append(int(data[1]))
-    return dict_arrsort(dict_list2arr(rval))
+    keys, units, times = {}, [], []
+    for block_keys, block_units, block_times in iter_gdf_blocks(file_name,
+                                                                block_size):
+        lookup = sp.array([keys.setdefault(k, len(keys)) for k in block_keys],
+                          dtype=int)
+        units.append(lookup[block_units])
+        times.append(block_times)
+    keys = sorted(keys, key=keys.get)
+    return _group_gdf(keys, sp.concatenate(units + [sp.zeros(0, dtype=int)]),
+                      sp.concatenate(times + [sp.zeros(0, dtype=sp.int64)]),
+                      as_set)
+
+
+def iter_gdf_sts(file_name, block_size=GDF_BLOCK_SIZE):
+    """iterates over a .gdf file in blocks, for files larger than memory
+
+    :type file_name: str
+    :param file_name: path to the file to read
+    :type block_size: int
+    :param block_size: number of bytes to parse at once
+
+    :returns: generator -- yields one dict per block, mapping unit id to the
+        sorted spike times of that unit within the block
+    """
+
+    for keys, units, times in iter_gdf_blocks(file_name, block_size):
+        yield _group_gdf(keys, units, times, False)
+
+
+def iter_gdf_blocks(file_name, block_size=GDF_BLOCK_SIZE):
+    """iterates over the valid lines of a .gdf file in blocks of whole lines
+
+    :type file_name: str
+    :param file_name: path to the file to read
+    :type block_size: int
+    :param block_size: number of bytes to read at once, a block is extended
+        to the end of its last line
+
+    :returns: generator -- yields tuples of the unit ids of the block, the
+        index into those ids and the int64 spike time of every valid line,
+        in file order
+    """
+
+    with open(file_name, 'rb') as arc:
+        tail = ''
+        while True:
+            chunk = arc.read(block_size)
+            if not chunk:
+                break
+            buf = tail + chunk
+            cut = buf.rfind('\n') + 1
+            buf, tail = buf[:cut], buf[cut:]
+            if buf:
+                yield _parse_gdf_block(buf)
+        if tail:
+            yield _parse_gdf_block(tail)
+
+
+def _parse_gdf_block(buf):
+    """parses the lines in :buf: on byte level, the tokens are found on the
+    byte array and counted per line, only lines with two tokens are kept
+    """
+
+    # token boundaries, whitespace as in str.split
+    buf = sp.frombuffer(buf, dtype=sp.uint8)
+    word = ((buf != 32) & (buf - sp.uint8(9) > 4)).view(sp.int8)
+    edges = sp.flatnonzero(sp.diff(sp.concatenate(([0], word, [0]))))
+    starts, ends = edges[0::2], edges[1::2]
+
+    # lines with exactly two tokens
+    line_ends = sp.concatenate((sp.flatnonzero(buf == 10), [buf.size]))
+    count = sp.diff(sp.concatenate(([0], sp.searchsorted(starts, line_ends))))
+    valid = sp.repeat(count == 2, count)
+    starts, ends = starts[valid], ends[valid]
+    id_lo, id_hi = starts[0::2], ends[0::2]
+    t_lo, t_hi = starts[1::2], ends[1::2]
+    if t_lo.size == 0:
+        return [], sp.zeros(0, dtype=int), sp.zeros(0, dtype=sp.int64)
+
+    # unit ids as zero padded bytes, ids of up to 8 bytes are read as big
+    # endian integers from an overlapping view, which keeps their order
+    width = max((id_hi - id_lo).max(), 8)
+    if width == 8:
+        padded = sp.concatenate((buf, sp.zeros(8, dtype=sp.uint8)))
+        words = sp.ndarray(shape=buf.shape, dtype='>u8', buffer=padded,
+                           strides=(1,))
+        shift = (8 * (8 - (id_hi - id_lo))).astype(sp.uint64)
+        ids = (words[id_lo] >> shift) << shift
+    else:
+        idx = id_lo[:, None] + sp.arange(width)[None, :]
+        ids = sp.where(idx < id_hi[:, None],
+                       buf[sp.minimum(idx, buf.size - 1)], 0)
+        ids = sp.ascontiguousarray(ids, dtype=sp.uint8)
+        ids = ids.view('S%d' % width).ravel()
+    keys, units = sp.unique(ids, return_inverse=True)
+    keys = map(str, keys.astype('>u8' if width == 8 else keys.dtype).view(
+        'S%d' % width))
+
+    # spike times from the right aligned digits, a leading sign is skipped
+    # and tokens that are no integers are converted with int
+    width = min((t_hi - t_lo).max(), 18)
+    idx = t_hi[:, None] - width + sp.arange(width)[None, :]
+    first = t_lo + ((buf[t_lo] == 43) | (buf[t_lo] == 45)) * (t_hi - t_lo > 1)
+    digits = buf[sp.maximum(idx, 0)] - sp.uint8(48)
+    digits[idx < first[:, None]] = 0
+    bad = (digits > 9).any(axis=1) | (t_hi - t_lo > 18)
+    times = sp.dot(digits.astype(sp.int64), _POW10[width - 1::-1])
+    times *= sp.where(buf[t_lo] == 45, -1, 1)
+    for i in sp.flatnonzero(bad):
+        times[i] = int(buf[t_lo[i]:t_hi[i]].tostring())
+    return keys, units, times
 
 
-def read_hdf5_arc(file_name):
+def _group_gdf(keys, units, times, as_set):
+    """groups the spike times by unit with one sort, the units are ordered by
+    key and the spike times sorted within every unit"""
+
+    rank = sp.empty(len(keys), dtype=int)
+    rank[sp.argsort(keys)] = sp.arange(len(keys))
+    units = rank[units]
+    lo = times.min() if times.size else 0
+    span = times.max() - lo + 1 if times.size else 1
+    if len(keys) * float(span) < 2 ** 62:
+        # sort the values of the combined key, which is faster than argsort
+        combined = sp.sort(units * span + (times - lo))
+        units, times = combined // span, combined % span + lo
+    else:
+        order = sp.lexsort((times, units))
+        units, times = units[order], times[order]
+    offsets = sp.concatenate(([0], sp.cumsum(sp.bincount(
+        units, minlength=len(keys))))).astype(int)
+    sts = SpikeTrainSet.from_arrays(sorted(keys), offsets, times)
+    if as_set is True:
+        return sts
+    return sts.to_dict()
+
+
+class HDF5RawData(RawData):
+    """lazy raw data on a 2d HDF5 array node
+
+    The samples are read from the node on demand and converted to float32
+    per read. If the node stores [channels, samples], which is assumed if
+    it has no more rows than columns, the reads are transposed.
+    """
+
+    def __init__(self, node, arc=None):
+        """
+        :type node: tables.Array
+        :param node: 2d array node holding the raw data
+        :type arc: tables.File
+        :param arc: if not None, the open file of the node, closed by
+            :close:
+        """
+
+        if node.ndim != 2:
+            raise ValueError('raw data node must have ndim==2')
+        self.node = node
+        self.arc = arc
+        self.transposed = node.shape[0] <= node.shape[1]
+        super(HDF5RawData, self).__init__(
+            node.shape[::-1] if self.transposed else node.shape)
+
+    def _read(self, start, stop, channels):
+        # slices are read from the node, other selections from the chunk
+        sel = channels if isinstance(channels, slice) else slice(None)
+        if self.transposed:
+            chunk = self.node[sel, start:stop].T
+        else:
+            chunk = self.node[start:stop, sel]
+        if not isinstance(channels, slice):
+            chunk = chunk[:, channels]
+        return chunk
+
+    def close(self):
+        """closes the file of the node"""
+
+        if self.arc is not None:
+            self.arc.close()
+
+
+class DatRawData(RawData):
+    """lazy raw data on a flat binary file of interleaved samples
+
+    The file is memory mapped as [samples, channels] without copying, see
+    :memmap:. Reads are scaled to float32 per read, as
+    gain * value + offset.
+    """
+
+    def __init__(self, file_name, nc, dtype=sp.int16, gain=1.0, offset=0.0,
+                 header=0):
+        """
+        :type file_name: str
+        :param file_name: path to the file to map
+        :type nc: int
+        :param nc: number of channels
+        :type dtype: dtype
+        :param dtype: sample dtype in the file
+            Default=int16
+        :type gain: float
+        :param gain: scale of the samples
+            Default=1.0
+        :type offset: float
+        :param offset: offset added after scaling
+            Default=0.0
+        :type header: int
+        :param header: number of bytes to skip at the start of the file
+            Default=0
+        """
+
+        dtype = sp.dtype(dtype)
+        ns = (os.path.getsize(file_name) - header) // (nc * dtype.itemsize)
+        if ns <= 0:
+            raise ValueError('%s holds no complete sample' % file_name)
+        self.memmap = sp.memmap(file_name, dtype=dtype, mode='r',
+                                offset=header, shape=(ns, nc))
+        self.gain = float(gain)
+        self.offset = float(offset)
+        super(DatRawData, self).__init__(self.memmap.shape)
+
+    def _read(self, start, stop, channels):
+        rval = self.memmap[start:stop, channels].astype(sp.float32)
+        if self.gain != 1.0:
+            rval *= self.gain
+        if self.offset != 0.0:
+            rval += self.offset
+        return rval
+
+
+def read_dat_arc(file_name, nc, srate=1000.0, dtype=sp.int16, gain=1.0,
+                 offset=0.0, header=0):
+    """maps a flat binary recording of interleaved samples, see
+    :DatRawData:
+
+    :type file_name: str
+    :param file_name: path to the file to read
+    :type nc: int
+    :param nc: number of channels
+    :type srate: float
+    :param srate: sampling rate in Hz
+        Default=1000.0
+
+    :returns: DatRawData: raw data [f32], float: sampling rate in Hz
+    """
+
+    return DatRawData(file_name, nc, dtype=dtype, gain=gain, offset=offset,
+                      header=header), float(srate)
+
+
+def read_hdf5_arc(file_name, lazy=False):
     """reads a .hdf file and returns data contents mapped in a dict
 
+    The raw data and sampling rate are read from the 'data' (or 'x') and
+    'srate' nodes of the archive root.
+
     :type file_name: str
     :param file_name: path to the file to read
+    :type lazy: bool
+    :param lazy: if True, return the raw data as :HDF5RawData:, which reads
+        from the open file on demand, close it with its :close: method
+        Default=False
 
-    :returns: ndarray: raw data [f32], float: sampling rate in Hz,
-    or None, None on read error
+    :returns: ndarray or HDF5RawData: raw data [f32], float: sampling rate in
+    Hz, or None, None on read error
     """
 
     data, srate = None, None
-    with openFile(file_name, 'r') as arc:
-        for node in arc:
-            # XXX: any more identifiers we used or the data in an archive?!
-            if node._v_name.lower() in ['data', 'x']:
-                data = sp.asanyarray(node.read())
-                try:
-                    data = data.astype(sp.float32)
-                    if data.shape[0] <= data.shape[1]:
-                        data = data.T.copy()
-                except:
-                    data = None
-            if node._v_name.lower() == 'srate':
-                try:
-                    srate = float(node.read())
-                except:
-                    srate = None
+    arc = openFile(file_name, 'r')
+    try:
+        # XXX: any more identifiers we used or the data in an archive?!
+        nodes = dict([(name.lower(), node)
+                      for name, node in arc.root._v_children.items()])
+        node = nodes.get('data', nodes.get('x'))
+        if node is not None:
+            try:
+                data = HDF5RawData(node, arc if lazy is True else None)
+                if lazy is not True:
+                    data = data.to_array()
+            except:
+                data = None
+        if 'srate' in nodes:
+            try:
+                srate = float(nodes['srate'].read())
+            except:
+                srate = None
+    finally:
+        if lazy is not True or data is None:
+            arc.close()
     return data, srate
 
 
-def create_hdf5_arc(file_name, rdata, srate=1000.0, **kwargs):
+def create_hdf5_arc(file_name, rdata, srate=1000.0, complevel=1,
+                    chunk_samples=None, expected_samples=None, **kwargs):
     """creates a valid hdf5 archive for :rdata:
 
+    The raw data is written block by block into a zlib compressed, chunked
+    and extendable array [samples, channels]. A chunk holds all channels of
+    :chunk_samples: consecutive samples, so reading a sample range touches
+    only the chunks of that range.
+
     :type file_name: str
     :param file_name: path to the file to write
-    :type rdata: ndarray
-    :param rdata: raw data array [samples, channels] castable to f32
+    :type rdata: ndarray or RawData or iterable
+    :param rdata: raw data array [samples, channels] castable to f32, or an
+        iterable (e.g. a generator) of such blocks with a common number of
+        channels, which are appended in order
     :type srate: float
     :param srate: sampling rate of rdata in Hz
         Default=1000.0
+    :type complevel: int
+    :param complevel: compression level 0-9, 0 for no compression
+        Default=1
+    :type chunk_samples: int
+    :param chunk_samples: samples per chunk, None for chunks of about
+        HDF5_CHUNK_BYTES
+        Default=None
+    :type expected_samples: int
+    :param expected_samples: expected number of samples, a hint for
+        iterables, known for arrays
+        Default=None
+    :keyword ??: metadata to store in the archive, castable to arrays
 
     :returns: True on success, False else
     """
@@ -83,10 +374,35 @@ def create_hdf5_arc(file_name, rdata, srate=1000.0, **kwargs):
     with openFile(file_name, 'w') as arc:
         # XXX: we go with 'data' here
         try:
-            data = sp.asanyarray(rdata, dtype=sp.float32)
-            if data.shape[0] <= rdata.shape[1]:
-                data = data.T
-            arc.createArray(arc.root, 'data', data)
+            if isinstance(rdata, RawData):
+                blocks = (chunk for start, chunk in rdata.iter_chunks(2 ** 16))
+                expected_samples = rdata.shape[0]
+            elif isinstance(rdata, sp.ndarray):
+                data = rdata
+                if data.shape[0] <= data.shape[1]:
+                    data = data.T
+                blocks = (data[i:i + 2 ** 16]
+                          for i in xrange(0, data.shape[0], 2 ** 16))
+                expected_samples = data.shape[0]
+            else:
+                blocks = iter(rdata)
+            node = None
+            for block in blocks:
+                block = sp.asarray(block, dtype=sp.float32)
+                if block.ndim != 2:
+                    raise ValueError('raw data blocks must have ndim==2')
+                if node is None:
+                    nc = block.shape[1]
+                    if chunk_samples is None:
+                        chunk_samples = max(HDF5_CHUNK_BYTES // (4 * nc), 1)
+                    node = arc.createEArray(
+                        arc.root, 'data', Float32Atom(), (0, nc),
+                        filters=Filters(complevel=complevel, complib='zlib'),
+                        chunkshape=(chunk_samples, nc),
+                        expectedrows=expected_samples or 2 ** 20)
+                node.append(block)
+            if node is None:
+                raise ValueError('no raw data')
             arc.createArray(arc.root, 'srate', srate)
             for k, v in kwargs.iteritems():
                 arc.createArray(arc.root, str(k), v)
@@ -122,6 +438,133 @@ def create_gdf(file_name, sts):
         except:
             return False
 
+def read_sts_arc(file_name):
+    """reads a spike train archive written by :create_sts_arc:
+
+    The spike times are memory mapped from the archive, opening it only
+    reads the unit ids and offsets and accessing a unit only touches the
+    pages of that unit.
+
+    :type file_name: str
+    :param file_name: path to the file to read
+
+    :returns: SpikeTrainSet: spike train set on the mapped spike times,
+    dict: metadata stored with the archive, including the sampling rate as
+    'srate' if it was stored
+    """
+
+    with zipfile.ZipFile(file_name, 'r') as arc:
+        names = [name[:-4] for name in arc.namelist() if name.endswith('.npy')]
+        if not all([name in names for name in STS_ARC_NAMES]):
+            raise ValueError('%s is not a spike train archive' % file_name)
+        keys = _read_npz_member(arc, 'keys').tolist()
+        offsets = _read_npz_member(arc, 'offsets')
+        metadata = {}
+        for name in names:
+            if name not in STS_ARC_NAMES:
+                value = _read_npz_member(arc, name)
+                metadata[name] = value[()] if value.ndim == 0 else value
+        times = _map_npz_member(file_name, arc, 'times')
+    return SpikeTrainSet.from_arrays(keys, offsets, times), metadata
+
+
+def create_sts_arc(file_name, sts, srate=None, **kwargs):
+    """creates a spike train archive for :sts:
+
+    The archive is an uncompressed .npz file with the spike times of all
+    units in one array, as in :SpikeTrainSet:, the unit ids and the unit
+    offsets, see :read_sts_arc:.
+
+    :type file_name: str
+    :param file_name: path to the file to write
+    :type sts: dict or SpikeTrainSet
+    :param sts: spike train set
+    :type srate: float
+    :param srate: sampling rate of the spike times in Hz, not stored if None
+        Default=None
+    :keyword ??: metadata to store with the archive, as arrays or scalars
+
+    :returns: True on success, False else
+    """
+
+    try:
+        sts = SpikeTrainSet(sts)
+        if any([k in STS_ARC_NAMES for k in kwargs]):
+            raise ValueError('reserved metadata name')
+        arrays = dict([(str(k), sp.asarray(v)) for k, v in kwargs.iteritems()])
+        if srate is not None:
+            arrays['srate'] = sp.asarray(float(srate))
+        arrays.update(keys=sp.asarray(sts.keys()),
+                      offsets=sts.offsets.astype(sp.int64),
+                      times=sts.data)
+        with open(file_name, 'wb') as arc:
+            sp.savez(arc, **arrays)
+        return True
+    except:
+        return False
+
+
+def gdf_to_sts_arc(gdf_name, arc_name, srate=None, **kwargs):
+    """converts a .gdf file into a spike train archive
+
+    :type gdf_name: str
+    :param gdf_name: path to the gdf file to read
+    :type arc_name: str
+    :param arc_name: path to the archive to write
+    :type srate: float
+    :param srate: sampling rate of the spike times in Hz
+
+    :returns: True on success, False else
+    """
+
+    return create_sts_arc(arc_name, read_gdf_sts(gdf_name, as_set=True),
+                          srate=srate, **kwargs)
+
+
+def sts_arc_to_gdf(arc_name, gdf_name):
+    """converts a spike train archive into a .gdf file
+
+    :type arc_name: str
+    :param arc_name: path to the archive to read
+    :type gdf_name: str
+    :param gdf_name: path to the gdf file to write
+
+    :returns: True on success, False else
+    """
+
+    sts, metadata = read_sts_arc(arc_name)
+    return create_gdf(gdf_name, sts)
+
+
+def _read_npz_member(arc, name):
+    """reads the array :name: from the open npz archive :arc:"""
+
+    return npy_format.read_array(arc.open(name + '.npy'))
+
+
+def _map_npz_member(file_name, arc, name):
+    """memory maps the array :name: of the npz file :file_name:, the member
+    has to be stored uncompressed"""
+
+    info = arc.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('%s is compressed and cannot be mapped' % name)
+    with open(file_name, 'rb') as fp:
+        # skip the local file header of the member and the npy header
+        fp.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack('<HH', fp.read(4))
+        fp.seek(info.header_offset + 30 + name_len + extra_len)
+        version = npy_format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(fp)
+        offset = fp.tell()
+    if sp.prod(shape) == 0:
+        return sp.zeros(shape, dtype=dtype)
+    return sp.memmap(file_name, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran_order else 'C')
+
 ##---MAIN
 
 if __name__ == '__main__':
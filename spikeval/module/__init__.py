@@ -16,7 +16,8 @@ from .base_module import *
 from .result_types import *
 from .mod_default import *
 from .mod_metric_franke import *
+from .mod_metric_meila import *
 
 ##---MODULES
 
-MODULES = [ModDefault, ModMetricFranke]
+MODULES = [ModDefault, ModMetricFranke, ModMetricMeila]
@@ -47,15 +47,21 @@ class BaseModule(object):
     :self._apply: is the execution content of the module and should implement
         the module and store any results in :self.result:.
 
+    Modules that set :RESULT_NAMES: alongside :RESULT_TYPES: can be asked
+    for a subset of their results with the 'outputs' parameter, results
+    that were not requested are left as None. Use :self.wants: to skip the
+    work for those.
+
     You may log any useful information using :self.logger:,
     which is a :Logger: instance.
     """
 
     RESULT_TYPES = []
+    RESULT_NAMES = []
 
     def __init__(self, raw_data, sts_gt, sts_ev, log, **parameters):
         """
-        :type raw_data: ndarray or None
+        :type raw_data: ndarray or RawData or None
         :param raw_data: raw data as ndarray with [samples, channels]
         :type sts_gt: dict
         :param sts_gt: ground truth spike train set
@@ -98,7 +104,40 @@ class BaseModule(object):
         :return: valid parameters
         """
 
-        return self._check_parameters(parameters)
+        parameters = dict(parameters)
+        outputs = parameters.pop('outputs', None)
+        rval = self._check_parameters(parameters)
+        rval['outputs'] = self.check_outputs(outputs)
+        return rval
+
+    def check_outputs(self, outputs):
+        """check the requested outputs
+
+        :type outputs: list or str or None
+        :param outputs: names of the requested results, None for all results
+        :raise ModuleInputError: if a name is not in :RESULT_NAMES:
+        :return: list of the requested result names or None
+        """
+
+        if outputs is None:
+            return None
+        if isinstance(outputs, basestring):
+            outputs = [outputs]
+        unknown = [name for name in outputs if name not in self.RESULT_NAMES]
+        if unknown:
+            raise ModuleInputError('outputs: unknown results %s' % unknown)
+        return list(outputs)
+
+    def wants(self, name):
+        """returns True if the result :name: was requested
+
+        :type name: str
+        :param name: result name from :RESULT_NAMES:
+        :rtype: bool
+        """
+
+        outputs = self.parameters.get('outputs')
+        return outputs is None or name in outputs
 
     def _check_parameters(self, parameters):
         return {}
@@ -123,7 +162,8 @@ class BaseModule(object):
         :type sts_gt: dict
         :param sts_gt: ground truth spike train set to validate
         :raise ModuleInputError: if :sts_gt: does not validate
-        :return: valid ground truth spike train set
+        :return: valid ground truth spike train set, a dict or
+            :SpikeTrainSet:
         """
 
         return self._check_sts_gt(sts_gt)
@@ -137,7 +177,8 @@ class BaseModule(object):
         :type sts_ev: dict
         :param sts_ev: evaluation spike train set to validate
         :raise ModuleInputError: if :sts_ev: does not validate
-        :return: valid evaluation spike train set
+        :return: valid evaluation spike train set, a dict or
+            :SpikeTrainSet:
         """
 
         return self._check_sts_ev(sts_ev)
@@ -148,11 +189,20 @@ class BaseModule(object):
     def apply(self):
         self._stage = 2
         self._apply()
+        self._finalise_result()
+
+    def _finalise_result(self):
+        """checks the result count and converts the results to the
+        :RESULT_TYPES:"""
+
         if len(self.RESULT_TYPES) != len(self.result):
             raise ModuleExecutionError('non-matching result count %d:%d' %
                                        (len(self.RESULT_TYPES),
                                         len(self.result)))
         for i in xrange(len(self.result)):
+            if self.result[i] is None and self.RESULT_NAMES and \
+                    not self.wants(self.RESULT_NAMES[i]):
+                continue
             if not isinstance(self.result[i], self.RESULT_TYPES[i]):
                 try:
                     self.result[i] = self.RESULT_TYPES[i](self.result[i])
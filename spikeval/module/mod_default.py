@@ -17,13 +17,24 @@ import scipy as sp
 from mdp import pca
 from .base_module import BaseModule, ModuleInputError, ModuleExecutionError
 from .result_types import MRPlot
-from ..util import extract_spikes, dict_arrsort, dict_list2arr
+from ..util import EXTRACT_BATCH_SIZE, SpikeTrainSet, extract_spikes
 from ..plot import cluster, cluster_projection, spike_trains, waveforms
 
 ##---CLASSES
 
 class ModDefault(BaseModule):
-    """module for default visuals"""
+    """module for default visuals
+
+    :Parameters:
+        max_waveforms_per_unit : int
+            if not None, at most this many waveforms per unit are extracted
+            and plotted, drawn by a seeded reservoir sample. The mean
+            waveforms are still computed over all spikes.
+            Default=None
+        seed : int
+            seed for the reservoir sample
+            Default=0
+    """
 
     RESULT_TYPES = [
         MRPlot, # waveforms by units
@@ -38,7 +49,10 @@ class ModDefault(BaseModule):
             'sampling_rate': parameters.get('sampling_rate', 32000.0),
             'cut': parameters.get('cut', (32, 32)),
             'name': parameters.get('name', 'noname'),
-            'noise_cov': parameters.get('noise_cov', None)}
+            'noise_cov': parameters.get('noise_cov', None),
+            'max_waveforms_per_unit': parameters.get('max_waveforms_per_unit',
+                                                     None),
+            'seed': parameters.get('seed', 0)}
 
     def _check_raw_data(self, raw_data):
         if raw_data is None:
@@ -52,29 +66,104 @@ class ModDefault(BaseModule):
     def _check_sts_ev(self, sts_ev):
         if sts_ev is None:
             raise ModuleInputError('sts_ev: needs evaluation spike train set')
-        dict_list2arr(sts_ev)
-        dict_arrsort(sts_ev)
-        return sts_ev
+        return SpikeTrainSet(sts_ev)
 
     def _apply(self):
         self._stage = 2
         cut = self.parameters['cut']
+        max_waveforms = self.parameters['max_waveforms_per_unit']
+        keys = self.sts_ev.keys()
         spikes = {}
-        for k, v in sorted(self.sts_ev.items()):
-            train = v[(v > cut[0]) * (v < self.raw_data.shape[0] - cut[1])]
-            if len(train) == 0:
-                continue
-            epochs = sp.vstack((
-                train - cut[0],
-                train + cut[1])).T
-            spikes[k] = extract_spikes(self.raw_data, epochs)
+        # extract the spikes of all units at once and split them by unit
+        times = self.sts_ev.data
+        valid = (times > cut[0]) * (times < self.raw_data.shape[0] - cut[1])
+        units = self.sts_ev.units[valid]
+        epochs = sp.vstack((
+            times[valid] - cut[0],
+            times[valid] + cut[1])).T
+        counts = sp.bincount(units, minlength=len(keys))
+        templates = None
+        if max_waveforms is not None:
+            # means over all spikes, waveforms of the sampled spikes only
+            means = ModDefault.mean_waveforms(self.raw_data, epochs, units,
+                                              len(keys))
+            templates = dict([(k, means[i]) for i, k in enumerate(keys)
+                              if counts[i] > 0])
+            sample = ModDefault.reservoir_sample(units, max_waveforms,
+                                                 self.parameters['seed'])
+            epochs, units = epochs[sample], units[sample]
+        waveforms_all = extract_spikes(self.raw_data, epochs)
+        offsets = sp.concatenate(([0], sp.cumsum(
+            sp.bincount(units, minlength=len(keys)))))
+        for i, k in enumerate(keys):
+            if offsets[i + 1] > offsets[i]:
+                spikes[k] = waveforms_all[offsets[i]:offsets[i + 1]]
 
         # produce plot results
-        self.plot_waveforms(spikes)
+        self.plot_waveforms(spikes, templates,
+                            dict([(k, counts[i]) for i, k in enumerate(keys)]))
         self.plot_clusters(spikes)
         self.plot_spike_trains()
 
-    def plot_waveforms(self, spikes):
+    @staticmethod
+    def reservoir_sample(units, k, seed=0):
+        """seeded reservoir sample of at most k spikes per unit
+
+        Every spike gets a random priority and the k spikes with the lowest
+        priority are kept per unit, which is the priority form of reservoir
+        sampling.
+
+        :type units: ndarray
+        :param units: unit index of every spike
+        :type k: int
+        :param k: maximal number of spikes per unit
+        :type seed: int
+        :param seed: seed of the random priorities
+        :returns: ndarray: sorted indices of the sampled spikes
+        """
+
+        priority = sp.random.RandomState(seed).random_sample(units.size)
+        order = sp.lexsort((priority, units))
+        sizes = sp.bincount(units)
+        rank = sp.empty(units.size, dtype=int)
+        rank[order] = sp.arange(units.size) - \
+                      (sp.cumsum(sizes) - sizes)[units[order]]
+        return sp.flatnonzero(rank < k)
+
+    @staticmethod
+    def mean_waveforms(raw_data, epochs, units, n, batch_size=None):
+        """mean waveform per unit over all epochs, accumulated over batches
+        of extracted spikes
+
+        :type raw_data: ndarray or RawData
+        :param raw_data: raw data [samples, channels]
+        :type epochs: ndarray
+        :param epochs: epochs to cut [[start,end]], with common length
+        :type units: ndarray
+        :param units: unit index of every epoch
+        :type n: int
+        :param n: number of units
+        :type batch_size: int
+        :param batch_size: number of spikes per batch, None for batches of
+            about EXTRACT_BATCH_SIZE samples
+        :returns: ndarray: mean waveforms [n, tf * nc], zero for units
+            without spikes
+        """
+
+        tf = epochs[0, 1] - epochs[0, 0] if epochs.size else 0
+        nc = raw_data.shape[1]
+        if batch_size is None:
+            batch_size = max(EXTRACT_BATCH_SIZE // max(tf * nc, 1), 1)
+        sums = sp.zeros((n, tf * nc))
+        for b in xrange(0, units.size, batch_size):
+            wf = extract_spikes(raw_data, epochs[b:b + batch_size])
+            u = units[b:b + batch_size]
+            start = sp.flatnonzero(sp.concatenate(([True], u[1:] != u[:-1])))
+            sp.add.at(sums, u[start], sp.add.reduceat(wf, start, axis=0))
+        counts = sp.bincount(units, minlength=n)
+        return sums / sp.maximum(counts, 1)[:, None]
+
+    def plot_waveforms(self, spikes, templates=None, counts=None):
         """:spikeplot.waveforms: plots
 
         There will be one plot with waveforms per unit and one plot with all
@@ -82,6 +171,11 @@ class ModDefault(BaseModule):
 
         :type spikes: dict
         :param spikes: one set of waveforms per unit {k:[n,samples]}
+        :type templates: dict
+        :param templates: if not None, mean waveform per unit to plot
+            instead of the mean of :spikes:
+        :type counts: dict
+        :param counts: if not None, spike count per unit for the labels
         """
 
         # produce plots for all units ...
@@ -93,6 +187,8 @@ class ModDefault(BaseModule):
                 plot_mean=True,
                 plot_single_waveforms=True,
                 plot_separate=True,
+                templates=templates,
+                counts=counts,
                 title='waveforms by units'))
 
         # produce plots for all spikes ...
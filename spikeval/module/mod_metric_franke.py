@@ -16,9 +16,13 @@ __all__ = ['ModMetricFranke']
 ##--- IMPORTS
 
 import scipy as sp
+from scipy import sparse
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
 from .base_module import BaseModule, ModuleInputError, ModuleExecutionError
 from .result_types import MRTable, MRDict
-from ..util import dict_arrsort, dict_list2arr, matrix_argmax
+from ..util import (PairAlignment, SpikeTrainSet, UnitArrays, expand_ranges,
+                    ranked_pairs)
 from spykeutils.spike_train_metrics import van_rossum_dist
 import quantities as pq
 import time
@@ -80,10 +84,12 @@ class ModMetricFranke(BaseModule):
     :Parameters:
         self.sts_gt : dict of ndarray
             dict containing 1d ndarrays/lists of integers, representing the
-            single unit spike trains. This is the ground truth.
+            single unit spike trains. This is the ground truth. It is
+            stored as a :SpikeTrainSet:.
         self.sts_ev : dict of ndarray
             dict containing 1d ndarrays/lists of integers, representing the
-            single unit spike trains. this is the estimation.
+            single unit spike trains. this is the estimation. It is stored
+            as a :SpikeTrainSet:.
         maxshift : int
             Upper bound for the tested shift of spike trains towards each
             other
@@ -94,10 +100,70 @@ class ModMetricFranke(BaseModule):
         maxoverlapdistance : int
             upper bound for the tested overlap distance
             Default=45
+        prefilter : bool
+            if True, bound the pairs of spike trains that can have a nonzero
+            similarity on coarsely binned spike trains first and compute the
+            exact similarity for those candidate pairs only.
+            Default=False
+        prefilter_binsize : int
+            bin size for the prefilter, at least maxshift. If None,
+            2*maxshift+1 is used.
+            Default=None
+        correspondence : str
+            strategy for the one to one correspondence of units, either
+            'greedy' to associate the unit pairs with the most assigned
+            spikes first, or 'optimal' for the maximum weight assignment.
+            Default='greedy'
+        chunk_size : int
+            if not None, process the recording in time chunks of chunk_size
+            samples with margins of maxjitter + maxoverlapdistance, holding
+            only the spikes and labels of one chunk in memory. The
+            similarity is computed exactly in a first chunked pass, the
+            alignment near the chunk borders may differ from the in memory
+            evaluation. The per spike results (alignment, O, EL, GL) are
+            returned empty and self.sts_ev is not shifted.
+            Default=None
+        label_file : str or file
+            in chunked mode, file name or file object the spike labels are
+            written to, one line "GT|EV <tab> unit <tab> time <tab> label" per
+            spike. If None, the labels are only counted.
+            Default=None
+        n_jobs : int
+            number of worker processes for the similarity, -1 uses all
+            CPUs. The results are identical to the serial computation. In
+            chunked mode the similarity is computed serially.
+            Default=1
+        outputs : list
+            names from :RESULT_NAMES: of the results to build, the other
+            results are None. The assignment is skipped if only the
+            similarity, shift or overlap results are requested, the spike
+            labels if no result depends on them.
+            Default=None (all results)
     """
 
     # module interface
 
+    RESULT_NAMES = [
+        'res_table',
+        'similarity_matrix',
+        'shift_matrix',
+        'delta_shift',
+        'alignment',
+        'O',
+        'spike_no_assignment_matrix',
+        'EL',
+        'GL',
+        'TP',
+        'TPO',
+        'FPA',
+        'FPAO',
+        'FN',
+        'FNO',
+        'FP',
+        'u_k2f',
+        'u_f2k',
+    ]
+
     RESULT_TYPES = [
         MRTable,  # res_table
         MRTable,  # similarity_matrix
@@ -122,24 +188,33 @@ class ModMetricFranke(BaseModule):
     def _check_sts_gt(self, sts_gt):
         if sts_gt is None:
             raise ModuleInputError('sts_gt: needs ground truth spike train set')
-        dict_list2arr(sts_gt)
-        dict_arrsort(sts_gt)
-        return sts_gt
+        return SpikeTrainSet(sts_gt)
 
     def _check_sts_ev(self, sts_ev):
         if sts_ev is None:
             raise ModuleInputError('sts_ev: needs evaluation spike train set')
-        dict_list2arr(sts_ev)
-        dict_arrsort(sts_ev)
-        return sts_ev
+        return SpikeTrainSet(sts_ev)
 
     def _check_parameters(self, parameters):
+        if parameters.get('correspondence', 'greedy') not in\
+           ['greedy', 'optimal']:
+            raise ModuleInputError('correspondence: must be one of '
+                                   '\'greedy\' or \'optimal\'')
+        if parameters.get('chunk_size', None) is not None and\
+           parameters['chunk_size'] <= 0:
+            raise ModuleInputError('chunk_size: must be positive')
         return {
             'sampling_rate': parameters.get('sampling_rate', 32000.0),
             'name': parameters.get('name', 'noname'),
             'maxshift': parameters.get('maxshift', 15),
             'maxjitter': parameters.get('maxjitter', 6),
-            'maxoverlapdistance': parameters.get('maxoverlapdistance', 45), }
+            'maxoverlapdistance': parameters.get('maxoverlapdistance', 45),
+            'prefilter': parameters.get('prefilter', False),
+            'prefilter_binsize': parameters.get('prefilter_binsize', None),
+            'correspondence': parameters.get('correspondence', 'greedy'),
+            'chunk_size': parameters.get('chunk_size', None),
+            'label_file': parameters.get('label_file', None),
+            'n_jobs': parameters.get('n_jobs', 1), }
 
     def _apply(self):
         global_tic = time.time()
@@ -149,36 +224,266 @@ class ModMetricFranke(BaseModule):
         n = len(self.sts_gt)
         m = len(self.sts_ev)
         max_shift = self.parameters['maxshift']
-        max_jitter = self.parameters['maxjitter']
-        max_oldist = self.parameters['maxoverlapdistance']
-        similarity_matrix = sp.zeros((n, m))
-        shift_matrix = sp.zeros((n, m))
-        sfuncs = sp.zeros((n, m, 2 * max_shift + 1))
+        chunk_size = self.parameters['chunk_size']
 
         self.logger.log("1) similarity")
         tic = time.time()
+        gt_trains = [self.sts_gt[k] for k in self.sts_gt.keys()]
+        ev_trains = [self.sts_ev[k] for k in self.sts_ev.keys()]
+        integral = all([sp.issubdtype(st.dtype, sp.integer)
+                        for st in gt_trains + ev_trains])
         # compute similarity score and optimal shift between all pairs of spike trains
-        for i in xrange(n):
-            for j in xrange(m):
-                sfunc = ModMetricFranke.similarity(
-                    self.sts_gt[self.sts_gt.keys()[i]],
-                    self.sts_ev[self.sts_ev.keys()[j]],
-                    max_shift)
-                similarity_matrix[i, j] = sfunc.max()
-                shift_matrix[i, j] = sfunc.argmax() - max_shift
-                sfuncs[i, j, :] = sfunc
+        if chunk_size is None:
+            sfuncs = self._similarity_functions(gt_trains, ev_trains)
+        else:
+            sfuncs, pairs = ModMetricFranke.similarity_chunked(
+                gt_trains, ev_trains, max_shift, chunk_size,
+                prefilter=self.parameters['prefilter'],
+                bin_size=self.parameters['prefilter_binsize'])
+            if pairs is not None:
+                self.logger.log("pruned {} of {} pairs".format(
+                    n * m - pairs.sum(), n * m))
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self._evaluate(sfuncs, integral)
+        self.logger.log_delimiter_line()
+        self.logger.log("total duration: {:05f}s".format(time.time() - global_tic))
+
+    def update(self, sts_ev_delta):
+        """re-evaluates the module after some units of the evaluation spike
+        train set changed
+
+        Requires a previous in memory evaluation by :apply: or :update:. The
+        similarity is computed for the changed units only and the overlaps
+        of the ground truth are reused. The alignments of the leading pairs
+        in the ranked order that are unchanged are reused, the assignment is
+        redone from the first changed pair on. The result is the same as
+        applying the module to the updated spike train set.
+
+        :type sts_ev_delta: dict
+        :param sts_ev_delta: new spike train per changed or added unit, None
+            removes the unit
+        """
+
+        # init and checks
+        if self._stage != 3 or self._state is None:
+            raise ModuleExecutionError('update: needs a previous evaluation '
+                                       'in memory')
+        global_tic = time.time()
+        self.logger.log("start update")
+        previous = self._state
+        delta = dict([(k, st) for k, st in sts_ev_delta.items()
+                      if st is not None])
+        sts_ev = dict(zip(previous['ev_keys'], previous['ev_trains']))
+        sts_ev.update(delta)
+        for k in sts_ev_delta.keys():
+            if sts_ev_delta[k] is None:
+                sts_ev.pop(k, None)
+        self.sts_ev = self._check_sts_ev(sts_ev)
+        self._stage = 2
+        n = len(self.sts_gt)
+        m = len(self.sts_ev)
+        max_shift = self.parameters['maxshift']
+        changed = set(sts_ev_delta.keys())
+
+        self.logger.log("1) similarity of {} changed units".format(
+            len(delta)))
+        tic = time.time()
+        gt_trains = [self.sts_gt[k] for k in self.sts_gt.keys()]
+        ev_trains = [self.sts_ev[k] for k in self.sts_ev.keys()]
+        integral = all([sp.issubdtype(st.dtype, sp.integer)
+                        for st in gt_trains + ev_trains])
+        old_index = dict([(k, j) for j, k in enumerate(previous['ev_keys'])])
+        sfuncs = sp.zeros((n, m, 2 * max_shift + 1))
+        new_cols = []
+        for j, k in enumerate(self.sts_ev.keys()):
+            if k in changed:
+                new_cols.append(j)
+            else:
+                sfuncs[:, j] = previous['sfuncs'][:, old_index[k]]
+        if len(new_cols) > 0:
+            sfuncs[:, new_cols] = self._similarity_functions(
+                gt_trains, [ev_trains[j] for j in new_cols])
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self._evaluate(sfuncs, integral,
+                       previous=dict(previous, changed=changed))
+        self._finalise_result()
+        self.logger.log_delimiter_line()
+        self.logger.log("total duration: {:05f}s".format(time.time() - global_tic))
+
+    def sweep(self, maxjitter, maxoverlapdistance=None):
+        """evaluates the module for a grid of jitter tolerances and overlap
+        distances
+
+        The similarity, shifting and pairing stages do not depend on the
+        tolerances and are computed once. The candidate spikes of every pair
+        of units are searched once for the largest jitter and filtered down
+        to the smaller jitters, see :align_ranges:. The overlaps are computed
+        once per overlap distance. self.sts_ev and self.result are not
+        changed.
+
+        :type maxjitter: list
+        :param maxjitter: jitter tolerances
+        :type maxoverlapdistance: list
+        :param maxoverlapdistance: overlap distances, if None the
+            maxoverlapdistance parameter is used.
+            Default=None
+        :returns: dict: result table, as the first result of :apply:, per
+            (maxjitter, maxoverlapdistance)
+        """
+
+        # init
+        global_tic = time.time()
+        self.logger.log("start sweep")
+        n = len(self.sts_gt)
+        m = len(self.sts_ev)
+        max_shift = self.parameters['maxshift']
+        jitters = sorted(set(maxjitter))
+        if maxoverlapdistance is None:
+            maxoverlapdistance = [self.parameters['maxoverlapdistance']]
+        oldists = sorted(set(maxoverlapdistance))
+        if len(jitters) == 0 or len(oldists) == 0:
+            return {}
+        gt_trains = [self.sts_gt[k] for k in self.sts_gt.keys()]
+        ev_trains = [self.sts_ev[k] for k in self.sts_ev.keys()]
+        integral = all([sp.issubdtype(st.dtype, sp.integer)
+                        for st in gt_trains + ev_trains])
+        num_known = sp.array([st.size for st in gt_trains], dtype=int)
+        num_found = sp.array([st.size for st in ev_trains], dtype=int)
+
+        self.logger.log("1) similarity, shifting and pairing")
+        tic = time.time()
+        sfuncs = self._similarity_functions(gt_trains, ev_trains)
+        similarity_matrix = sfuncs.max(axis=2)
+        shift_matrix = (sfuncs.argmax(axis=2) - max_shift).astype(float)
+        delta_shift = sp.zeros(m)
+        for j in xrange(m):
+            myidx = similarity_matrix[:, j].argmax()
+            delta_shift[j] = shift_matrix[myidx, j]
+            ev_trains[j] = ev_trains[j] + delta_shift[j]
+        sorted_tupels = ranked_pairs(similarity_matrix)
+        skip = {}
+        for jitter in jitters:
+            skip[jitter] = sp.zeros((n, m), dtype=bool)
+            if integral is True:
+                skip[jitter] = (similarity_matrix == 0) * \
+                    (sp.absolute(delta_shift) + jitter <= max_shift)[None, :]
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self.logger.log("2) candidates")
+        tic = time.time()
+        # candidate ranges of every pair for the largest jitter, the ranges
+        # for the smaller jitters drop the candidates beyond the jitter at
+        # both ends
+        ranges = dict([(jitter, {}) for jitter in jitters])
+        tupels = sorted_tupels[~skip[jitters[-1]][sorted_tupels[:, 0],
+                                                  sorted_tupels[:, 1]]]
+        for i, j in tupels:
+            st1, st2 = gt_trains[i], ev_trains[j]
+            lo = sp.searchsorted(st1, st2 - jitters[-1], 'left')
+            hi = sp.searchsorted(st1, st2 + jitters[-1], 'right')
+            idx2 = sp.flatnonzero(lo < hi)
+            lo, hi = lo[idx2], hi[idx2]
+            own, idx1 = expand_ranges(lo, hi)
+            dist = st1[idx1] - st2[idx2[own]]
+            for jitter in jitters:
+                ranges[jitter][(i, j)] = (
+                    idx2,
+                    lo + sp.bincount(own, weights=dist < -jitter,
+                                     minlength=idx2.size).astype(int),
+                    hi - sp.bincount(own, weights=dist > jitter,
+                                     minlength=idx2.size).astype(int))
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self.logger.log("3) overlaps")
+        tic = time.time()
+        gt_ovp = {}
+        for oldist in oldists:
+            flags = ModMetricFranke.overlap_flags(gt_trains, oldist)
+            gt_ovp[oldist] = sp.concatenate(
+                flags + [sp.zeros(0, dtype=sp.bool_)])
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
+        self.logger.log("4) assignment and evaluation")
+        tic = time.time()
+        rval = {}
+        for jitter in jitters:
+            GFree = [sp.ones(st.shape, dtype=bool) for st in gt_trains]
+            EFree = [sp.ones(st.shape, dtype=bool) for st in ev_trains]
+            aligned = ModMetricFranke.assign_spikes(
+                gt_trains, ev_trains,
+                sorted_tupels[~skip[jitter][sorted_tupels[:, 0],
+                                            sorted_tupels[:, 1]]],
+                jitter, GFree, EFree, ranges=ranges[jitter])
+            spike_no_assignment_matrix = sp.zeros((n, m))
+            for (k1idx, k2idx), (idx1, idx2) in aligned.items():
+                spike_no_assignment_matrix[k1idx, k2idx] = idx1.size
+            u_k2f, u_f2k = ModMetricFranke.unit_correspondence(
+                spike_no_assignment_matrix, self.parameters['correspondence'])
+            for oldist in oldists:
+                gt_labels, ev_labels = ModMetricFranke.spike_labels(
+                    num_known, num_found, aligned, gt_ovp[oldist], u_k2f)
+                NO = sp.bincount(
+                    sp.repeat(sp.arange(n), num_known),
+                    weights=gt_ovp[oldist], minlength=n)
+                rval[(jitter, oldist)] = self._result_table(
+                    num_known.astype(float), num_found.astype(float), NO,
+                    ModMetricFranke.label_counts(gt_labels, num_known),
+                    ModMetricFranke.label_counts(ev_labels, num_found),
+                    u_k2f)
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+        self.logger.log_delimiter_line()
+        self.logger.log("total duration: {:05f}s".format(time.time() - global_tic))
+        return rval
+
+    def _similarity_functions(self, gt_trains, ev_trains):
+        """similarity functions of all pairs of spike trains, see
+        :similarity_tensor:"""
+
+        # prune pairs of spike trains that cannot have any coincidence
+        max_shift = self.parameters['maxshift']
+        pairs = None
+        if self.parameters['prefilter'] is True:
+            pairs = ModMetricFranke.candidate_pairs(
+                gt_trains, ev_trains, max_shift,
+                bin_size=self.parameters['prefilter_binsize'])
+            self.logger.log("pruned {} of {} pairs".format(
+                pairs.size - pairs.sum(), pairs.size))
+        return ModMetricFranke.similarity_tensor(
+            gt_trains, ev_trains, max_shift, pairs=pairs,
+            n_jobs=self.parameters['n_jobs'])
+
+    def _evaluate(self, sfuncs, integral, previous=None):
+        """evaluation given the similarity functions of all pairs of units,
+        see :update: for previous"""
+
+        # init
+        n = len(self.sts_gt)
+        m = len(self.sts_ev)
+        max_shift = self.parameters['maxshift']
+        max_jitter = self.parameters['maxjitter']
+        max_oldist = self.parameters['maxoverlapdistance']
+        chunk_size = self.parameters['chunk_size']
+        gt_trains = [self.sts_gt[k] for k in self.sts_gt.keys()]
+        ev_trains = [self.sts_ev[k] for k in self.sts_ev.keys()]
+        ev_orig = list(ev_trains)
+        similarity_matrix = sfuncs.max(axis=2)
+        shift_matrix = (sfuncs.argmax(axis=2) - max_shift).astype(float)
+        self._state = None
+
         self.logger.log("2) shifting")
         tic = time.time()
         # shift all estimated spike trains so that they fit optimal to the best matching true
-        # spike train
+        # spike train, in chunked mode the spike trains are shifted chunk by chunk
         u_f2k = sp.zeros(m)
         delta_shift = sp.zeros(m)
         for j in xrange(m):
             myidx = similarity_matrix[:, j].argmax()
             delta_shift[j] = shift_matrix[myidx, j]
-            self.sts_ev[self.sts_ev.keys()[j]] = self.sts_ev[self.sts_ev.keys()[j]] + delta_shift[j]
+        if chunk_size is None:
+            self.sts_ev = self.sts_ev.shifted(delta_shift)
+            ev_trains = [self.sts_ev[k] for k in self.sts_ev.keys()]
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
         self.logger.log("3) pairing")
@@ -186,201 +491,328 @@ class ModMetricFranke(BaseModule):
         # sort the spiketrain pairings according to their similarity measure this ensures that the
         # best matching spiketrains will get all the matching spikes. no spike that matches will
         # thus be aligned to another spike train.
-        sorted_tupels = []
-        S = similarity_matrix.copy()
-        for i in xrange(n * m):
-            maxidx = S.argmax()
-            sorted_tupels.append((int(sp.floor(maxidx / m)), maxidx % m))
-            S[sorted_tupels[i]] = -1
+        sorted_tupels = ranked_pairs(similarity_matrix)
+        # pairs without any coincidence within +/-maxshift cannot have spikes
+        # within the jitter window, as long as the shifted jitter window stays
+        # within +/-maxshift and all spike times are integral
+        skip = sp.zeros((n, m), dtype=bool)
+        if integral is True:
+            skip = (similarity_matrix == 0) * \
+                   (sp.absolute(delta_shift) + max_jitter <= max_shift)[None, :]
+        sorted_tupels = sorted_tupels[~skip[sorted_tupels[:, 0],
+                                            sorted_tupels[:, 1]]]
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
-        self.logger.log("4) alignment")
+        if chunk_size is not None:
+            self._apply_chunked(gt_trains, ev_trains, similarity_matrix,
+                                shift_matrix, delta_shift, sorted_tupels)
+            return
+
+        # only the stages needed for the requested outputs are run
+        need_labels = any(map(self.wants, [
+            'res_table', 'EL', 'GL', 'TP', 'TPO', 'FPA', 'FPAO', 'FN', 'FNO',
+            'FP']))
+        need_assignment = need_labels or any(map(self.wants, [
+            'alignment', 'spike_no_assignment_matrix', 'u_k2f', 'u_f2k']))
+        num_known = sp.array([st.size for st in gt_trains], dtype=float)
+        num_found = sp.array([st.size for st in ev_trains], dtype=float)
+        # all spikes are handled in one array per spike train set, indexed by
+        # the unit offsets
+        gt_offsets = sp.concatenate(([0], sp.cumsum(num_known))).astype(int)
+        ev_offsets = sp.concatenate(([0], sp.cumsum(num_found))).astype(int)
+        aligned = spike_no_assignment_matrix = u_k2f = u_f2k = None
+        O = NO = gt_counts = ev_counts = alignment = EL = GL = None
+
+        if need_assignment:
+            self.logger.log("4) alignment")
+            tic = time.time()
+            GFree = [sp.ones(st.shape, dtype=bool) for st in gt_trains]
+            EFree = [sp.ones(st.shape, dtype=bool) for st in ev_trains]
+
+            # GFree will contain for every _inserted_ spike a True or a False
+            # True: it was not assigned to any of the found spike trains => FN
+            # False: it was assigned to a spike of self.sts_ev => either TP or FN + FPA
+            #
+            # EFree will contain for every _found_ spike a True or a False
+            # True: it was not assigned to any of the inserted spike trains => FP
+            # False: it was assigned to a spike of self.sts_gt => it will be handled when self.sts_gt is analyzed!
+            self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+            self.logger.log("5) assignment")
+            tic = time.time()
+            # with a previous evaluation, the alignments of the leading pairs
+            # that did not change are reused and their spikes blocked
+            start, aligned = 0, {}
+            if previous is not None:
+                start, aligned = ModMetricFranke.reused_alignment(
+                    previous, sorted_tupels, self.sts_ev.keys())
+                for (k1idx, k2idx), (idx1, idx2) in aligned.items():
+                    GFree[k1idx][idx1] = False
+                    EFree[k2idx][idx2] = False
+                self.logger.log("reused {} of {} pairs".format(
+                    start, len(sorted_tupels)))
+            # run over the sorted tupels and block all established spike
+            # assignments, aligned holds the index arrays of the aligned
+            # spikes per pair of units
+            aligned.update(ModMetricFranke.assign_spikes(
+                gt_trains, ev_trains, sorted_tupels[start:], max_jitter,
+                GFree, EFree))
+            spike_no_assignment_matrix = sp.zeros((n, m))
+            for (k1idx, k2idx), (idx1, idx2) in aligned.items():
+                spike_no_assignment_matrix[k1idx, k2idx] = idx1.size
+                # We cannot calculate TP/FP/FNs here, since we dont know yet which self.sts_gt
+                # belongs to which self.sts_ev (see next step)
+
+            # now establish the one to one relationships between the true and
+            # found spike trains. this is a different relationship than the
+            # one before because there can maximal be min(n,m) associations.
+            # If there are more found spike trains than inserted (m>n), some
+            # wont have a partner and be thus treated as FPs. If there are
+            # more inserted than found (m>n) than some will be treated as
+            # being not found (FNs).
+            self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+            self.logger.log("6) unit correspondence")
+            tic = time.time()
+            # Assignment vectors between true and estimated units
+            u_k2f, u_f2k = ModMetricFranke.unit_correspondence(
+                spike_no_assignment_matrix, self.parameters['correspondence'])
+
+            # now we want to calculate FPs and FNs. Since in
+            # spike_no_assignment_matrix the assigned spikes are coded and in
+            # u_k2f and u_f2k the assignments of the units to each other, we
+            # can now compare the number of assignments to the total number
+            # of spikes in the corresponding trains. this will directly give
+            # the correct/error numbers.
+            self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        if need_labels or self.wants('O'):
+            self.logger.log("7) evaluation")
+            tic = time.time()
+            # mark all the overlapping spikes, they depend on the ground truth
+            # only
+            if previous is not None and previous['O'] is not None:
+                O = previous['O']
+            else:
+                O = UnitArrays(self.sts_gt.keys(), gt_offsets, sp.concatenate(
+                    ModMetricFranke.overlap_flags(gt_trains, max_oldist) +
+                    [sp.zeros(0, dtype=sp.bool_)]))
+            NO = sp.bincount(O.units, weights=O.data.astype(float),
+                             minlength=n)
+            self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self.logger.log("8) results")
         tic = time.time()
-        # init alignment dictonary
-        alignment = {}
-        idx = 0
-        for i in xrange(n):
-            for j in xrange(m):
-                alignment[(self.sts_gt.keys()[i], self.sts_ev.keys()[j])] = []
-                idx += 1
+        if need_labels:
+            # label every single spike
+            gt_labels, ev_labels = ModMetricFranke.spike_labels(
+                num_known.astype(int), num_found.astype(int), aligned, O.data,
+                u_k2f)
 
-        # convert self.sts_gt and self.sts_ev to lists, otherwise we cant remove objects
-        GBlocked = {}
-        EBlocked = {}
-        num_known = sp.zeros(n)
-        for i in xrange(n):
-            num_known[i] = self.sts_gt[self.sts_gt.keys()[i]].shape[0]
-            GBlocked[self.sts_gt.keys()[i]] = sp.zeros(self.sts_gt[self.sts_gt.keys()[i]].shape)
-        num_found = sp.zeros(m)
-        for j in xrange(m):
-            num_found[j] = self.sts_ev[self.sts_ev.keys()[j]].shape[0]
-            EBlocked[self.sts_ev.keys()[j]] = sp.zeros(self.sts_ev[self.sts_ev.keys()[j]].shape)
-
-        # GBlocked will contain for every _inserted_ spike a 0 or a 1
-        # 0: it was not assigned to any of the found spike trains => FN
-        # 1: it was assigned to a spike of self.sts_ev => either TP or FN + FPA
-        #
-        # EBlocked will contain for every _found_ spike a 0 or a 1
-        # 0: it was not assigned to any of the inserted spike trains => FP
-        # 1: it was assigned to a spike of self.sts_gt => it will be handled when self.sts_gt is analyzed!
+            # count the labels per unit, assignment errors are counted twice
+            gt_counts = ModMetricFranke.label_counts(
+                gt_labels, num_known.astype(int))
+            ev_counts = ModMetricFranke.label_counts(
+                ev_labels, num_found.astype(int))
+
+            # per unit results, as views on the flat arrays
+            GL = UnitArrays(self.sts_gt.keys(), gt_offsets, gt_labels)
+            EL = UnitArrays(self.sts_ev.keys(), ev_offsets, ev_labels)
+        if self.wants('alignment'):
+            alignment = PairAlignment.from_aligned(
+                self.sts_gt.keys(), self.sts_ev.keys(), aligned)
+
+        # Build return _value dictionary
+        self._build_result(
+            similarity_matrix, shift_matrix, delta_shift, alignment, O,
+            spike_no_assignment_matrix, EL, GL, num_known, num_found, NO,
+            gt_counts, ev_counts, u_k2f, u_f2k)
+
+        # keep the state for :update:
+        if aligned is not None:
+            self._state = {
+                'ev_keys': self.sts_ev.keys(),
+                'ev_trains': ev_orig,
+                'sfuncs': sfuncs,
+                'tupels': sorted_tupels,
+                'aligned': aligned,
+                'O': O}
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
-        self.logger.log("5) assignment")
+    def _apply_chunked(self, gt_trains, ev_trains, similarity_matrix,
+                       shift_matrix, delta_shift, sorted_tupels):
+        """alignment and evaluation in time chunks, see :chunk_size:
+
+        The alignment is run twice over the chunks, first to count the
+        assigned spikes for the unit correspondence and then to label the
+        spikes. Only the labels of the current chunk are held in memory, they
+        are counted and written to :label_file:.
+        """
+
+        # init
+        n, m = len(gt_trains), len(ev_trains)
+        max_jitter = self.parameters['maxjitter']
+        max_oldist = self.parameters['maxoverlapdistance']
+        chunk_size = self.parameters['chunk_size']
+        margin = max_jitter + max_oldist
+        gt_keys, ev_keys = self.sts_gt.keys(), self.sts_ev.keys()
+        labelList = ['', 'TP', 'TPO', 'FP', 'FPA', 'FPAO', 'FN', 'FNO']
+
+        self.logger.log("4) chunked assignment")
         tic = time.time()
         spike_no_assignment_matrix = sp.zeros((n, m))
-        # run over the sorted tupels and block all established spike assignments
-        for i in xrange(n * m):
-            k1idx = sorted_tupels[i][0]
-            k2idx = sorted_tupels[i][1]
-            k1 = self.sts_gt.keys()[sorted_tupels[i][0]]
-            k2 = self.sts_ev.keys()[sorted_tupels[i][1]]
-            train1 = self.sts_gt[k1]
-            train2 = self.sts_ev[k2]
-            idx1 = 0
-            idx2 = 0
-            while idx1 < len(train1) and \
-                            idx2 < len(train2):
-                # if a spike is blocked it cannot be associated anymore. jump
-                if GBlocked[k1][idx1] == 1:
-                    idx1 += 1
-                    continue
-                if EBlocked[k2][idx2] == 1:
-                    idx2 += 1
-                    continue
-
-                if train1[idx1] <= train2[idx2] + max_jitter and train1[idx1] >= train2[idx2] - max_jitter:
-                    # spike assignment found, remove spikes
-                    alignment[(k1, k2)].append((idx1, idx2))
-                    GBlocked[k1][idx1] = 1
-                    EBlocked[k2][idx2] = 1
-
-                    spike_no_assignment_matrix[k1idx, k2idx] += 1
-                    # We cannot calculate TP/FP/FNs here, since we dont know yet which self.sts_gt
-                    # belongs to which self.sts_ev (see next step)
-                if train1[idx1] < train2[idx2]:
-                    idx1 += 1
-                else:
-                    idx2 += 1
-
-        # now establish the one to one relationships between the true and
-        # found spike trains. this is a different relationship than the one
-        # before because there can maximal be min(n,m) associations. If there
-        # are more found spike trains than inserted (m>n), some wont have a
-        # partner and be thus treated as FPs. If there are more inserted than
-        # found (m>n) than some will be treated as being not found (FNs).
+        for t0, t1, aligned, done in ModMetricFranke.chunk_alignments(
+                gt_trains, ev_trains, delta_shift, sorted_tupels, max_jitter,
+                chunk_size, margin):
+            for (k1idx, k2idx), (idx1, idx2) in aligned.items():
+                spike_no_assignment_matrix[k1idx, k2idx] += idx1.size
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
-        self.logger.log("6) unit correspondence")
+        self.logger.log("5) unit correspondence")
         tic = time.time()
-        # Assignment vectors between true and estimated units
-        u_k2f = sp.ones(n, dtype=sp.int16) * -1
-        u_f2k = sp.ones(m, dtype=sp.int16) * -1
-
-        nAssociations = min(n, m)
-        found = 0
-        count = 0
-        blocked_rows = []
-        blocked_cols = []
-        snam = spike_no_assignment_matrix.copy()
-        while (found < nAssociations) and (count < n * m):
-            i, j = matrix_argmax(snam)
-            if i not in blocked_rows and j not in blocked_cols:
-                blocked_rows.append(i)
-                u_k2f[i] = j
-                blocked_cols.append(j)
-                u_f2k[j] = i
-                found += 1
-            snam[i, j] = -1
-            count += 1
-
-        # now we want to calculate FPs and FNs. Since in
-        # spike_no_assignment_matrix the assigned spikes are coded and in
-        # u_k2f and u_f2k the assignments of the units to each other, we can
-        # now compare the number of assignments to the total number of spikes
-        # in the corresponding trains. this will directly give the
-        # correct/error numbers.
+        u_k2f, u_f2k = ModMetricFranke.unit_correspondence(
+            spike_no_assignment_matrix, self.parameters['correspondence'])
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
-        self.logger.log("7) evaluation")
+        self.logger.log("6) chunked evaluation")
         tic = time.time()
-        # mark all the overlapping spikes
-        ret = ModMetricFranke.overlaps(self.sts_gt, max_oldist)
-        O = ret['O']
-        NO = ret['Onums']
-
-        # initialize dictionaries for labels for all spikes
-        GL = {}
-        for k in self.sts_gt.keys():
-            GL[k] = sp.zeros(self.sts_gt[k].shape, dtype=sp.int16)
-        EL = {}
-        for k in self.sts_ev.keys():
-            EL[k] = sp.zeros(self.sts_ev[k].shape, dtype=sp.int16)
+        num_known = sp.array([st.size for st in gt_trains], dtype=float)
+        num_found = sp.array([st.size for st in ev_trains], dtype=float)
+        NO = sp.zeros(n)
+        gt_counts = sp.zeros((n, 8))
+        ev_counts = sp.zeros((m, 8))
+        label_file = self.parameters['label_file']
+        fp = label_file
+        if isinstance(label_file, basestring):
+            fp = open(label_file, 'w')
+        try:
+            for t0, t1, aligned, done in ModMetricFranke.chunk_alignments(
+                    gt_trains, ev_trains, delta_shift, sorted_tupels,
+                    max_jitter, chunk_size, margin):
+                lines = []
+                # ground truth spikes of the chunk, the overlaps are exact on
+                # the chunk extended by the overlap distance
+                lo = [sp.searchsorted(st, t0, 'left') for st in gt_trains]
+                hi = [sp.searchsorted(st, t1, 'left') for st in gt_trains]
+                wlo = [sp.searchsorted(st, t0 - max_oldist, 'left')
+                       for st in gt_trains]
+                whi = [sp.searchsorted(st, t1 + max_oldist, 'left')
+                       for st in gt_trains]
+                gt_ovp = ModMetricFranke.overlap_flags(
+                    [gt_trains[i][wlo[i]:whi[i]] for i in xrange(n)],
+                    max_oldist)
+                gt_ovp = [gt_ovp[i][lo[i] - wlo[i]:hi[i] - wlo[i]]
+                          for i in xrange(n)]
+                gt_labels = [sp.zeros(hi[i] - lo[i], dtype=sp.int8)
+                             for i in xrange(n)]
+                ev_idx = [[] for j in xrange(m)]
+                ev_labels = [[] for j in xrange(m)]
+                for (i, j), (idx1, idx2) in aligned.items():
+                    labels = ModMetricFranke.match_labels(
+                        i, j, gt_ovp[i][idx1 - lo[i]], u_k2f)
+                    gt_labels[i][idx1 - lo[i]] = labels
+                    ev_idx[j].append(idx2)
+                    ev_labels[j].append(labels)
+                for i in xrange(n):
+                    no_label = gt_labels[i] == 0
+                    gt_labels[i][no_label] = sp.where(
+                        gt_ovp[i][no_label], 7, 6)  # FNO, FN
+                    gt_counts[i] += sp.bincount(gt_labels[i], minlength=8)
+                    NO[i] += gt_ovp[i].sum()
+                    lines.extend(
+                        ['GT\t%s\t%s\t%s\n' % (gt_keys[i], t, labelList[l])
+                         for t, l in zip(gt_trains[i][lo[i]:hi[i]],
+                                         gt_labels[i])])
+
+                # estimated spikes, a spike that is not aligned when the
+                # ground truth spikes within the jitter are committed is a FP
+                for j in xrange(m):
+                    flo = sp.searchsorted(
+                        ev_trains[j], t0 - max_jitter - delta_shift[j], 'left')
+                    fhi = sp.searchsorted(
+                        ev_trains[j], t1 - max_jitter - delta_shift[j], 'left')
+                    fp_idx = sp.setdiff1d(sp.arange(flo, fhi), done[j])
+                    idx = sp.concatenate(ev_idx[j] + [fp_idx]).astype(int)
+                    labels = sp.concatenate(
+                        ev_labels[j] + [sp.ones(fp_idx.size, dtype=int) * 3])
+                    order = sp.argsort(idx, kind='mergesort')
+                    idx, labels = idx[order], labels[order].astype(int)
+                    ev_counts[j] += sp.bincount(labels, minlength=8)
+                    lines.extend(
+                        ['EV\t%s\t%s\t%s\n' % (ev_keys[j], t, labelList[l])
+                         for t, l in zip(ev_trains[j][idx], labels)])
+                if fp is not None:
+                    fp.writelines(lines)
+        finally:
+            if fp is not label_file:
+                fp.close()
         self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
-        self.logger.log("8) results")
+        self.logger.log("7) results")
         tic = time.time()
-        # run over every single spike and check which label it gets
-        # 1      2      3     4       5     6      7
-        labelList = ['TP', 'TPO', 'FP', 'FPA', 'FPAO', 'FN', 'FNO']
-        TP = sp.zeros(n)
-        TPO = sp.zeros(n)
-        FP = sp.zeros(m)  # m !!
-        FPA = sp.zeros(n)
-        FPAO = sp.zeros(n)
-        FPA_E = sp.zeros(m)  # m!!
-        FPAO_E = sp.zeros(m)  # m!!
-        FN = sp.zeros(n)
-        FNO = sp.zeros(n)
-        # handle the spikes which were aligned first
-        for i in xrange(n):
-            k1 = self.sts_gt.keys()[i]
-            for j in xrange(m):
-                k2 = self.sts_ev.keys()[j]
-                for a in xrange(len(alignment[(k1, k2)])):
-                    ovp = O[k1][alignment[(k1, k2)][a][0]]
-                    # labelList = ['TP', 'TPO', 'FP', 'FPA', 'FPAO', 'FN',
-                    # 'FNO']
-                    if u_k2f[i] == j:
-                        if ovp == 1:
-                            GL[k1][alignment[(k1, k2)][a][0]] = 2  # TPO
-                            EL[k2][alignment[(k1, k2)][a][1]] = 2
-                            TPO[i] += 1
-                        else:
-                            GL[k1][alignment[(k1, k2)][a][0]] = 1  # TP
-                            EL[k2][alignment[(k1, k2)][a][1]] = 1
-                            TP[i] += 1
-                    else:
-                        if ovp == 1:
-                            GL[k1][alignment[(k1, k2)][a][0]] = 5  # FPAO
-                            EL[k2][alignment[(k1, k2)][a][1]] = 5
-                            FPAO[i] += 1
-                            FPAO_E[
-                                j] += 1  # Count assignment errors twice! FP + FN
-                        else:
-                            GL[k1][alignment[(k1, k2)][a][0]] = 4  # FPA
-                            EL[k2][alignment[(k1, k2)][a][1]] = 4
-                            FPA[i] += 1
-                            FPA_E[j] += 1  # Count assignment errors twice!
-
-            # Now check all spikes of i which have no labels. those are FNs
-            for spk in xrange(len(GL[k1])):
-                if GL[k1][spk] == 0:
-                    if O[k1][spk] == 1:
-                        GL[k1][spk] = 7  # FNO
-                        FNO[i] += 1
-                    else:
-                        GL[k1][spk] = 6  # FN
-                        FN[i] += 1
-                        # The last thing to do is to check all labels of
-                        # spikes in self.sts_ev. Those which have no label
-                        # yet are FPs
-        for j in xrange(m):
-            k2 = self.sts_ev.keys()[j]
-            FP[j] = 0
-            for spk in xrange(len(EL[k2])):
-                if EL[k2][spk] == 0:
-                    EL[k2][spk] = 3  # FP
-                    FP[j] += 1
+        # the per spike results are not kept in chunked mode
+        self._build_result(
+            similarity_matrix, shift_matrix, delta_shift, {}, {},
+            spike_no_assignment_matrix, {}, {}, num_known, num_found, NO,
+            gt_counts, ev_counts, u_k2f, u_f2k)
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+    def _build_result(self, similarity_matrix, shift_matrix, delta_shift,
+                      alignment, O, spike_no_assignment_matrix, EL, GL,
+                      num_known, num_found, NO, gt_counts, ev_counts, u_k2f,
+                      u_f2k):
+        """builds self.result from the label counts, the outputs that were
+        not requested are None"""
+
+        res_table = None
+        if self.wants('res_table'):
+            res_table = self._result_table(num_known, num_found, NO,
+                                           gt_counts, ev_counts, u_k2f)
+        TP = TPO = FPA = FPAO = FN = FNO = FP = None
+        if gt_counts is not None:
+            TP, TPO, FPA, FPAO, FN, FNO = [
+                sp.atleast_2d(gt_counts[:, k]) for k in [1, 2, 4, 5, 6, 7]]
+        if ev_counts is not None:
+            FP = sp.atleast_2d(ev_counts[:, 3])
+        if u_k2f is not None:
+            u_k2f, u_f2k = sp.atleast_2d(u_k2f), sp.atleast_2d(u_f2k)
+        result = [
+            res_table,  # table
+            similarity_matrix,  # table
+            shift_matrix,  # table
+            sp.atleast_2d(delta_shift),  # table
+            alignment,  # dict
+            O,  # dict
+            spike_no_assignment_matrix,  # table
+            EL,  # dict
+            GL,  # dict
+            TP,  # table
+            TPO,  # table
+            FPA,  # table
+            FPAO,  # table
+            FN,  # table
+            FNO,  # table
+            FP,  # table
+            u_k2f,  # table
+            u_f2k,  # table
+        ]
+        self.result = [value if self.wants(name) else None
+                       for name, value in zip(self.RESULT_NAMES, result)]
+
+    def _result_table(self, num_known, num_found, NO, gt_counts, ev_counts,
+                      u_k2f):
+        """builds the result table from the label counts"""
+
+        n, m = len(num_known), len(num_found)
+        TP = gt_counts[:, 1]
+        TPO = gt_counts[:, 2]
+        FP = ev_counts[:, 3]  # m !!
+        FPA = gt_counts[:, 4]
+        FPAO = gt_counts[:, 5]
+        FPA_E = ev_counts[:, 4]  # m!!
+        FPAO_E = ev_counts[:, 5]  # m!!
+        FN = gt_counts[:, 6]
+        FNO = gt_counts[:, 7]
 
         res_table_headers = [
             'GT Unit ID',  # ID of gt unit
@@ -450,44 +882,679 @@ class ModMetricFranke(BaseModule):
                 fpaoe = FPAO_E[j]
                 res_table.append([unitk, unitf, known, overlapping, found, tp,
                                   tpo, fpa, fpae, fpao, fpaoe, fn, fno, fp])
-
-        # Build return _value dictionary
-        self.result = [
-            MRTable(res_table, header=res_table_headers),  # table
-            similarity_matrix,  # table
-            shift_matrix,  # table
-            sp.atleast_2d(delta_shift),  # table
-            alignment,  # dict
-            O,  # dict
-            spike_no_assignment_matrix,  # table
-            EL,  # dict
-            GL,  # dict
-            sp.atleast_2d(TP),  # table
-            sp.atleast_2d(TPO),  # table
-            sp.atleast_2d(FPA),  # table
-            sp.atleast_2d(FPAO),  # table
-            sp.atleast_2d(FN),  # table
-            sp.atleast_2d(FNO),  # table
-            sp.atleast_2d(FP),  # table
-            sp.atleast_2d(u_k2f),  # table
-            sp.atleast_2d(u_f2k),  # table
-        ]
-        self.logger.log("duration: {:05f}s".format(time.time() - tic))
-        self.logger.log_delimiter_line()
-        self.logger.log("total duration: {:05f}s".format(time.time() - global_tic))
+        return MRTable(res_table, header=res_table_headers)
 
     @staticmethod
     def similarity(st1, st2, mtau):
-        """calculates xcorr function between spike trains st1 and st2"""
+        """calculates xcorr function between spike trains st1 and st2
 
-        # st1_q = st1 * pq.ms / 32.0
-        # st2_q = st2 * pq.ms / 32.0
+        This yields the same values as applying :simi_kernel: to st1 and st2
+        shifted by every tau in [-mtau, mtau], see :similarity_tensor:.
+        """
 
-        rval = sp.zeros(2 * mtau + 1)
-        for tau in xrange(-mtau, mtau + 1):
-            rval[tau + mtau] = ModMetricFranke.simi_kernel(st1, st2 + tau)
-            # rval[tau + mtau] = van_rossum_dist((st1_q, st2_q + tau * pq.ms / 32.0), sort=False)[0, 1]
-        return rval
+        return ModMetricFranke.similarity_tensor([st1], [st2], mtau)[0, 0]
+
+    @staticmethod
+    def align_spikes(st1, st2, jitter, free1=None, free2=None):
+        """aligns the spikes of the sorted spike trains st1 and st2
+
+        Every free spike of st2, in order, is aligned to the first free
+        spike of st1 that lies within +/-jitter and was neither aligned nor
+        passed over before. This is the greedy alignment of a two pointer walk
+        over both trains. The candidate range in st1 is found for all spikes
+        of st2 at once with searchsorted. Only consecutive spikes of st2
+        with overlapping candidate ranges compete for spikes of st1; these
+        conflict clusters are resolved in parallel, one position per round.
+
+        :type st1: ndarray
+        :param st1: sorted spike train
+        :type st2: ndarray
+        :param st2: sorted spike train
+        :type jitter: int
+        :param jitter: maximum distance of aligned spikes
+        :type free1: ndarray
+        :param free1: bool, spikes of st1 that may be aligned. If None all
+            spikes may be aligned.
+            Default=None
+        :type free2: ndarray
+        :param free2: bool, spikes of st2 that may be aligned. If None all
+            spikes may be aligned.
+            Default=None
+        :returns: tuple: index arrays of the aligned spikes in st1 and st2
+        """
+
+        # init
+        st1, st2 = sp.asarray(st1), sp.asarray(st2)
+        if free1 is None:
+            free1 = sp.ones(st1.size, dtype=bool)
+        if free2 is None:
+            free2 = sp.ones(st2.size, dtype=bool)
+
+        # candidate range of every spike of st2 in st1
+        return ModMetricFranke.align_ranges(
+            sp.arange(st2.size),
+            sp.searchsorted(st1, st2 - jitter, 'left'),
+            sp.searchsorted(st1, st2 + jitter, 'right'),
+            free1, free2)
+
+    @staticmethod
+    def align_ranges(idx2, lo, hi, free1, free2):
+        """aligns the spikes idx2 of a spike train st2 to the spikes of a
+        spike train st1, given the range [lo, hi) of candidate spikes in st1
+        of every spike, see :align_spikes:
+
+        :type idx2: ndarray
+        :param idx2: sorted indices of spikes in st2
+        :type lo: ndarray
+        :param lo: first candidate spike in st1 per spike in idx2
+        :type hi: ndarray
+        :param hi: end of the candidate spikes in st1 per spike in idx2
+        :type free1: ndarray
+        :param free1: bool, spikes of st1 that may be aligned
+        :type free2: ndarray
+        :param free2: bool, spikes of st2 that may be aligned
+        :returns: tuple: index arrays of the aligned spikes in st1 and st2
+        """
+
+        # candidate range [p, q] of every spike in the ranks of the free
+        # spikes of st1
+        rval = sp.zeros(0, dtype=int), sp.zeros(0, dtype=int)
+        rank = sp.concatenate(([0], sp.cumsum(free1)))
+        p = rank[lo]
+        q = rank[hi] - 1
+        sel = sp.flatnonzero(free2[idx2] & (p <= q))
+        if sel.size == 0:
+            return rval
+        cand, p, q = idx2[sel], p[sel], q[sel]
+
+        # conflict clusters of candidates with overlapping ranges
+        start = sp.ones(cand.size, dtype=bool)
+        start[1:] = p[1:] > q[:-1]
+        cluster = sp.cumsum(start) - 1
+        pos = sp.arange(cand.size) - sp.flatnonzero(start)[cluster]
+
+        # resolve the clusters, the k-th candidate of every cluster per round
+        last = sp.ones(cluster[-1] + 1, dtype=int) * -1
+        rank_aligned = sp.ones(cand.size, dtype=int) * -1
+        round_idx = sp.argsort(pos, kind='mergesort')
+        round_bounds = sp.concatenate(([0], sp.cumsum(sp.bincount(pos))))
+        for k in xrange(round_bounds.size - 1):
+            sel = round_idx[round_bounds[k]:round_bounds[k + 1]]
+            c = cluster[sel]
+            a = sp.maximum(p[sel], last[c] + 1)
+            ok = a <= q[sel]
+            rank_aligned[sel[ok]] = a[ok]
+            last[c[ok]] = a[ok]
+
+        # return
+        ok = rank_aligned >= 0
+        return sp.flatnonzero(free1)[rank_aligned[ok]], cand[ok]
+
+    @staticmethod
+    def assign_spikes(sts1, sts2, tupels, jitter, free1, free2, ranges=None):
+        """aligns the spikes of the pairs of spike trains in tupels, in order
+
+        The aligned spikes are blocked in free1 and free2, so no spike is
+        aligned to more than one spike train, see :align_spikes:.
+
+        :type sts1: list
+        :param sts1: list of n sorted spike trains
+        :type sts2: list
+        :param sts2: list of m sorted spike trains
+        :type tupels: ndarray
+        :param tupels: [k, 2] pairs of indices into sts1 and sts2
+        :type jitter: int
+        :param jitter: maximum distance of aligned spikes
+        :type free1: list
+        :param free1: list of n bool arrays, spikes of sts1 that may be
+            aligned, updated in place
+        :type free2: list
+        :param free2: list of m bool arrays, spikes of sts2 that may be
+            aligned, updated in place
+        :type ranges: dict
+        :param ranges: if not None, the candidate ranges (idx2, lo, hi) per
+            pair (i, j) for the jitter, see :align_ranges:.
+            Default=None
+        :returns: dict: index arrays (idx1, idx2) of the aligned spikes per
+            pair (i, j) with aligned spikes
+        """
+
+        aligned = {}
+        for i, j in tupels:
+            if not (free1[i].any() and free2[j].any()):
+                continue
+            if ranges is None:
+                idx1, idx2 = ModMetricFranke.align_spikes(
+                    sts1[i], sts2[j], jitter, free1[i], free2[j])
+            else:
+                idx1, idx2 = ModMetricFranke.align_ranges(
+                    *ranges[(i, j)], free1=free1[i], free2=free2[j])
+            if idx1.size > 0:
+                # spike assignment found, remove spikes
+                aligned[(i, j)] = idx1, idx2
+                free1[i][idx1] = False
+                free2[j][idx2] = False
+        return aligned
+
+    @staticmethod
+    def reused_alignment(previous, tupels, ev_keys):
+        """finds the leading pairs in the ranked order tupels that are
+        unchanged since a previous evaluation, see :update:
+
+        :type previous: dict
+        :param previous: state of the previous evaluation, with the keys
+            'ev_keys', 'tupels', 'aligned' and 'changed', the set of changed
+            unit keys
+        :type tupels: ndarray
+        :param tupels: [k, 2] ranked pairs of units
+        :type ev_keys: list
+        :param ev_keys: keys of the evaluation units
+        :returns: tuple: number of leading pairs, and the alignments of these
+            pairs indexed by the current units
+        """
+
+        # previous index of every evaluation unit, -1 if changed
+        old_index = dict([(k, j) for j, k in enumerate(previous['ev_keys'])])
+        to_old = sp.array([-1 if k in previous['changed'] else
+                           old_index.get(k, -1) for k in ev_keys], dtype=int)
+        to_new = dict([(j_old, j) for j, j_old in enumerate(to_old)
+                       if j_old >= 0])
+
+        # first pair that differs in the ranked order
+        old = previous['tupels']
+        k = min(len(old), len(tupels))
+        same = (old[:k, 0] == tupels[:k, 0]) & \
+               (old[:k, 1] == to_old[tupels[:k, 1]]) & \
+               (to_old[tupels[:k, 1]] >= 0)
+        start = k if same.all() else int(sp.argmin(same))
+
+        # alignments of the leading pairs
+        m_old = len(previous['ev_keys'])
+        leading = set((old[:start, 0] * m_old + old[:start, 1]).tolist())
+        aligned = {}
+        for (i, j_old), value in previous['aligned'].items():
+            if i * m_old + j_old in leading:
+                aligned[(i, to_new[j_old])] = value
+        return start, aligned
+
+    @staticmethod
+    def match_labels(k1idx, k2idx, is_ovp, u_k2f):
+        """labels aligned spikes of the units k1idx and k2idx
+
+        :returns: ndarray: label 1 (TP), 2 (TPO), 4 (FPA) or 5 (FPAO) of the
+            aligned spikes, given their overlap flags is_ovp
+        """
+
+        is_tp = u_k2f[k1idx] == k2idx
+        return sp.where(is_tp,
+                        sp.where(is_ovp, 2, 1),  # TPO, TP
+                        sp.where(is_ovp, 5, 4))  # FPAO, FPA
+
+    @staticmethod
+    def spike_labels(sizes1, sizes2, aligned, ovp1, u_k2f):
+        """labels all spikes of the ground truth and the evaluation
+
+        The spikes are handled in one array per spike train set, ordered by
+        unit. Aligned spikes are labelled by :match_labels:, the other
+        spikes of the ground truth are FN (6) or FNO (7) and the other spikes
+        of the evaluation are FP (3).
+
+        :type sizes1: ndarray
+        :param sizes1: [n] spike count per ground truth unit
+        :type sizes2: ndarray
+        :param sizes2: [m] spike count per evaluation unit
+        :type aligned: dict
+        :param aligned: index arrays (idx1, idx2) per aligned pair (i, j)
+        :type ovp1: ndarray
+        :param ovp1: bool, overlap flag of every ground truth spike
+        :type u_k2f: ndarray
+        :param u_k2f: [n] associated evaluation unit or -1
+        :returns: tuple: int8 labels of the ground truth and the evaluation
+            spikes
+        """
+
+        # init
+        offsets1 = sp.concatenate(([0], sp.cumsum(sizes1))).astype(int)
+        offsets2 = sp.concatenate(([0], sp.cumsum(sizes2))).astype(int)
+        labels1 = sp.zeros(offsets1[-1], dtype=sp.int8)
+        labels2 = sp.zeros(offsets2[-1], dtype=sp.int8)
+
+        # handle the spikes which were aligned first
+        if len(aligned) > 0:
+            pairs = aligned.keys()
+            sizes = [aligned[p][0].size for p in pairs]
+            pair_i = sp.repeat([p[0] for p in pairs], sizes)
+            pair_j = sp.repeat([p[1] for p in pairs], sizes)
+            idx1 = offsets1[pair_i] + sp.concatenate(
+                [aligned[p][0] for p in pairs])
+            idx2 = offsets2[pair_j] + sp.concatenate(
+                [aligned[p][1] for p in pairs])
+            labels = ModMetricFranke.match_labels(
+                pair_i, pair_j, ovp1[idx1], u_k2f)
+            labels1[idx1] = labels
+            labels2[idx2] = labels
+
+        # all ground truth spikes which have no labels are FNs, all
+        # evaluation spikes which have no labels are FPs
+        no_label = labels1 == 0
+        labels1[no_label] = sp.where(ovp1[no_label], 7, 6)  # FNO, FN
+        labels2[labels2 == 0] = 3  # FP
+        return labels1, labels2
+
+    @staticmethod
+    def label_counts(labels, sizes):
+        """counts the labels per unit
+
+        :type labels: ndarray
+        :param labels: labels of all spikes, ordered by unit
+        :type sizes: ndarray
+        :param sizes: spike count per unit
+        :returns: ndarray: [units, 8] count of every label per unit
+        """
+
+        n = len(sizes)
+        units = sp.repeat(sp.arange(n), sizes)
+        return sp.bincount(units * 8 + labels,
+                           minlength=n * 8).reshape(n, 8).astype(float)
+
+    @staticmethod
+    def chunk_alignments(sts1, sts2, delta, tupels, jitter, chunk_size,
+                         margin):
+        """aligns the spikes of the pairs of spike trains in tupels chunk by
+        chunk, see :assign_spikes:
+
+        The time axis is cut into chunks of chunk_size. The spikes of every
+        chunk are aligned on a window extended by margin to both sides, with
+        the spikes aligned in earlier chunks blocked, and the alignments of
+        the spikes of sts1 inside the chunk are committed. Near the chunk
+        borders the alignment may differ from the alignment of the whole
+        spike trains.
+
+        :type sts1: list
+        :param sts1: list of n sorted spike trains
+        :type sts2: list
+        :param sts2: list of m sorted spike trains, unshifted
+        :type delta: ndarray
+        :param delta: [m] shift applied to the spike trains in sts2
+        :type tupels: ndarray
+        :param tupels: [k, 2] pairs of indices into sts1 and sts2
+        :type jitter: int
+        :param jitter: maximum distance of aligned spikes
+        :type chunk_size: int
+        :param chunk_size: length of a chunk in samples
+        :type margin: int
+        :param margin: extension of the chunk window, at least jitter
+        :returns: generator: tuple (t0, t1, aligned, done) per chunk [t0, t1),
+            with the committed index arrays per pair (i, j) in aligned and in
+            done the indices per spike train in sts2 aligned so far that lie
+            at or after t0 - margin
+        """
+
+        # init
+        n, m = len(sts1), len(sts2)
+        bounds = [(st[0], st[-1]) for st in sts1 if st.size > 0]
+        bounds += [(sts2[j][0] + delta[j], sts2[j][-1] + delta[j])
+                   for j in xrange(m) if sts2[j].size > 0]
+        if len(bounds) == 0:
+            return
+        t_start = min([b[0] for b in bounds])
+        n_chunks = int((max([b[1] for b in bounds]) - t_start) // chunk_size) + 1
+        carry1 = [sp.zeros(0, dtype=int) for i in xrange(n)]
+        carry2 = [sp.zeros(0, dtype=int) for j in xrange(m)]
+
+        # chunks
+        for c in xrange(n_chunks):
+            t0 = t_start + c * chunk_size
+            t1 = t0 + chunk_size if c < n_chunks - 1 else sp.inf
+            lo1 = [sp.searchsorted(st, t0 - margin, 'left') for st in sts1]
+            hi1 = [sp.searchsorted(st, t1 + margin, 'left') for st in sts1]
+            lo2 = [sp.searchsorted(sts2[j], t0 - margin - delta[j], 'left')
+                   for j in xrange(m)]
+            hi2 = [sp.searchsorted(sts2[j], t1 + margin - delta[j], 'left')
+                   for j in xrange(m)]
+            win1 = [sts1[i][lo1[i]:hi1[i]] for i in xrange(n)]
+            win2 = [sts2[j][lo2[j]:hi2[j]] + delta[j] for j in xrange(m)]
+            free1 = [sp.ones(st.size, dtype=bool) for st in win1]
+            free2 = [sp.ones(st.size, dtype=bool) for st in win2]
+            for i in xrange(n):
+                free1[i][carry1[i] - lo1[i]] = False
+            for j in xrange(m):
+                free2[j][carry2[j] - lo2[j]] = False
+
+            # commit the alignments of the spikes of sts1 inside the chunk
+            aligned = {}
+            new1 = [[carry1[i]] for i in xrange(n)]
+            new2 = [[carry2[j]] for j in xrange(m)]
+            for (i, j), (idx1, idx2) in ModMetricFranke.assign_spikes(
+                    win1, win2, tupels, jitter, free1, free2).items():
+                t = win1[i][idx1]
+                keep = (t >= t0) & (t < t1)
+                if keep.any():
+                    aligned[(i, j)] = idx1[keep] + lo1[i], idx2[keep] + lo2[j]
+                    new1[i].append(aligned[(i, j)][0])
+                    new2[j].append(aligned[(i, j)][1])
+            done = [sp.sort(sp.concatenate(new2[j])) for j in xrange(m)]
+            yield t0, t1, aligned, done
+
+            # carry the committed spikes that reach into the next window
+            for i in xrange(n):
+                idx = sp.concatenate(new1[i])
+                carry1[i] = idx[sts1[i][idx] >= t1 - margin]
+            for j in xrange(m):
+                carry2[j] = done[j][
+                    sts2[j][done[j]] + delta[j] >= t1 - margin]
+
+    @staticmethod
+    def unit_correspondence(M, method='greedy'):
+        """establishes the one to one correspondence between the ground truth
+        units (rows of M) and the evaluation units (columns of M)
+
+        There are min(n, m) associations. With the 'greedy' method the
+        pairs are visited in order of descending M, see :ranked_pairs:, and
+        associated if neither unit is associated yet. With the 'optimal'
+        method the associations maximise the sum of M over all associated
+        pairs (maximum weight bipartite matching).
+
+        :type M: ndarray
+        :param M: [n, m] weight matrix, e.g. the number of assigned spikes
+        :type method: str
+        :param method: one of 'greedy' or 'optimal'
+            Default='greedy'
+        :returns: tuple: u_k2f [n] and u_f2k [m] int16, the index of the
+            associated unit or -1
+        """
+
+        # init
+        n, m = M.shape
+        u_k2f = sp.ones(n, dtype=sp.int16) * -1
+        u_f2k = sp.ones(m, dtype=sp.int16) * -1
+        n_associations = min(n, m)
+        if n_associations == 0:
+            return u_k2f, u_f2k
+
+        # associate
+        if method == 'greedy':
+            found = 0
+            for i, j in ranked_pairs(M):
+                if u_k2f[i] == -1 and u_f2k[j] == -1:
+                    u_k2f[i] = j
+                    u_f2k[j] = i
+                    found += 1
+                    if found == n_associations:
+                        break
+        elif method == 'optimal':
+            from scipy.optimize import linear_sum_assignment
+
+            rows, cols = linear_sum_assignment(-sp.asarray(M, dtype=float))
+            u_k2f[rows] = cols
+            u_f2k[cols] = rows
+        else:
+            raise ValueError('unknown method: %s' % method)
+        return u_k2f, u_f2k
+
+    @staticmethod
+    def candidate_pairs(sts1, sts2, mtau, bin_size=None):
+        """bounds the pairs of spike trains from sts1 and sts2 that can have
+        a nonzero similarity
+
+        The spike trains are binned coarsely with bins of at least mtau
+        samples. Two spikes within +/-mtau fall into the same or into
+        neighbouring bins, so a pair can only have coincidences if the binned
+        trains share an occupied bin or neighbouring bins. This is computed
+        as a sparse product of the bin occupancy matrices.
+
+        :type sts1: list
+        :param sts1: list of n spike trains
+        :type sts2: list
+        :param sts2: list of m spike trains
+        :type mtau: int
+        :param mtau: maximum shift
+        :type bin_size: int
+        :param bin_size: bin size, at least mtau. If None, 2*mtau+1 is used.
+            Default=None
+        :returns: ndarray: [n, m] bool, True for the candidate pairs
+        """
+
+        # init
+        sts1 = [sp.asarray(st) for st in sts1]
+        sts2 = [sp.asarray(st) for st in sts2]
+        n, m = len(sts1), len(sts2)
+        bin_size = max(bin_size or 2 * mtau + 1, mtau, 1)
+        n1 = [st.size for st in sts1]
+        n2 = [st.size for st in sts2]
+        if sum(n1) == 0 or sum(n2) == 0:
+            return sp.zeros((n, m), dtype=bool)
+
+        # bin occupancy, the bins of sts2 are widened by one bin each side
+        b1 = sp.floor(sp.concatenate(sts1) / float(bin_size)).astype(int)
+        b2 = sp.floor(sp.concatenate(sts2) / float(bin_size)).astype(int)
+        b_min = min(b1.min(), b2.min()) - 1
+        nb = max(b1.max(), b2.max()) - b_min + 2
+        u1 = sp.repeat(sp.arange(n), n1)
+        u2 = sp.repeat(sp.arange(m), n2)
+        occ1 = sparse.coo_matrix(
+            (sp.ones(b1.size), (u1, b1 - b_min)), shape=(n, nb)).tocsr()
+        occ2 = sparse.coo_matrix(
+            (sp.ones(3 * b2.size),
+             (sp.tile(u2, 3), sp.concatenate([b2 - b_min - 1, b2 - b_min,
+                                              b2 - b_min + 1]))),
+            shape=(m, nb)).tocsr()
+        return (occ1 * occ2.T).toarray() > 0
+
+    @staticmethod
+    def similarity_tensor(sts1, sts2, mtau, pairs=None, batch_size=1000000,
+                          n_jobs=1):
+        """calculates xcorr functions between all pairs of spike trains from
+        sts1 and sts2
+
+        All spikes of sts1 are merged into one time sorted, unit labelled
+        stream. The spikes of sts2 are merged into that stream in one sweep,
+        collecting every coincidence within +/-mtau together with its unit
+        pair and shift. The coincidences are counted per (unit1, unit2, tau),
+        so the cost grows with the total spike count plus the number of
+        coincidences, not with the number of unit pairs.
+
+        :type sts1: list
+        :param sts1: list of n sorted spike trains
+        :type sts2: list
+        :param sts2: list of m sorted spike trains
+        :type mtau: int
+        :param mtau: maximum shift
+        :type pairs: ndarray
+        :param pairs: [n, m] bool, if not None only the pairs marked True are
+            computed, all others are zero. Units without any marked pair are
+            left out of the sweep, see :candidate_pairs:.
+            Default=None
+        :type batch_size: int
+        :param batch_size: number of spikes from sts2 to merge at once, bounds
+            the memory used for the coincidences.
+            Default=1000000
+        :type n_jobs: int
+        :param n_jobs: number of worker processes, the rows of sts1 are
+            split into blocks of about equal spike count that are counted in
+            parallel, see :coincidences_parallel:. -1 uses all CPUs.
+            Default=1
+        :returns: ndarray: [n, m, 2*mtau+1] xcorr function of every pair, as
+            :simi_kernel: would yield for every shift tau in [-mtau, mtau]
+        """
+
+        # init
+        n1 = sp.array([sp.asarray(st).size for st in sts1], dtype=int)
+        n2 = sp.array([sp.asarray(st).size for st in sts2], dtype=int)
+        if n_jobs == 1:
+            counts = ModMetricFranke.coincidences(
+                sts1, sts2, mtau, pairs=pairs, batch_size=batch_size)
+        else:
+            counts = ModMetricFranke.coincidences_parallel(
+                sts1, sts2, mtau, n_jobs, pairs=pairs, batch_size=batch_size)
+
+        # normalise
+        norm = sp.maximum(n1[:, None] + n2[None, :], 1)[:, :, None]
+        return 2.0 * counts / norm
+
+    @staticmethod
+    def coincidences(sts1, sts2, mtau, pairs=None, batch_size=1000000):
+        """counts the coincidences between all pairs of spike trains from sts1
+        and sts2 for every shift tau in [-mtau, mtau]
+
+        See :similarity_tensor: for the parameters.
+
+        :returns: ndarray: [n, m, 2*mtau+1] int coincidence counts
+        """
+
+        # init
+        sts1 = [sp.asarray(st) for st in sts1]
+        sts2 = [sp.asarray(st) for st in sts2]
+        n, m, nt = len(sts1), len(sts2), 2 * mtau + 1
+        counts = sp.zeros((n, m, nt), dtype=int)
+        if pairs is not None:
+            pairs = sp.asarray(pairs, dtype=bool)
+            use1, use2 = pairs.any(axis=1), pairs.any(axis=0)
+            sts1 = [sts1[i] if use1[i] else sts1[i][:0] for i in xrange(n)]
+            sts2 = [sts2[j] if use2[j] else sts2[j][:0] for j in xrange(m)]
+        if sum([st.size for st in sts1]) == 0 or\
+           sum([st.size for st in sts2]) == 0:
+            return counts
+
+        # every spike in sts2 is coincident at shift tau with at most one
+        # distinct spike time of each train in sts1, see :simi_kernel:
+        usts1 = [sp.unique(st) for st in sts1]
+        t1 = sp.concatenate(usts1)
+        u1 = sp.repeat(sp.arange(n), [st.size for st in usts1])
+        sort_idx = sp.argsort(t1, kind='mergesort')
+        t1, u1 = t1[sort_idx], u1[sort_idx]
+        t2 = sp.concatenate(sts2)
+        u2 = sp.repeat(sp.arange(m), [st.size for st in sts2])
+
+        # count coincidences per (unit1, unit2, tau)
+        counts = counts.ravel()
+        for b in xrange(0, t2.size, batch_size):
+            bt2, bu2 = t2[b:b + batch_size], u2[b:b + batch_size]
+            lo = sp.searchsorted(t1, bt2 - mtau, 'left')
+            hi = sp.searchsorted(t1, bt2 + mtau, 'right')
+            idx2, idx1 = expand_ranges(lo, hi)
+            tau = t1[idx1] - bt2[idx2]
+            if not sp.issubdtype(tau.dtype, sp.integer):
+                exact = tau == sp.floor(tau)
+                idx1, idx2, tau = idx1[exact], idx2[exact], tau[exact]
+            counts += sp.bincount(
+                (u1[idx1] * m + bu2[idx2]) * nt + (tau + mtau).astype(int),
+                minlength=n * m * nt)
+        counts.shape = n, m, nt
+        if pairs is not None:
+            counts[~pairs] = 0
+        return counts
+
+    @staticmethod
+    def coincidences_parallel(sts1, sts2, mtau, n_jobs, pairs=None,
+                              batch_size=1000000):
+        """counts the coincidences as :coincidences:, with the rows of sts1
+        split across a pool of n_jobs worker processes
+
+        The spike trains are copied once into shared memory that the workers
+        map on start up, the tasks only carry the row ranges. The blocks are
+        collected in order, so the counts are identical to the serial ones.
+
+        :returns: ndarray: [n, m, 2*mtau+1] int coincidence counts
+        """
+
+        # init
+        sts1 = [sp.asarray(st) for st in sts1]
+        sts2 = [sp.asarray(st) for st in sts2]
+        n, m, nt = len(sts1), len(sts2), 2 * mtau + 1
+        if n_jobs < 1:
+            n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+        n_blocks = min(n_jobs, n)
+        if n_blocks < 2:
+            return ModMetricFranke.coincidences(
+                sts1, sts2, mtau, pairs=pairs, batch_size=batch_size)
+
+        # blocks of rows with about equal spike count
+        cum = sp.cumsum([st.size for st in sts1])
+        bounds = sp.searchsorted(
+            cum, cum[-1] * sp.arange(1, n_blocks) / float(n_blocks), 'right')
+        bounds = sp.unique(sp.concatenate(([0], bounds, [n])))
+        tasks = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            block_pairs = None
+            if pairs is not None:
+                block_pairs = sp.asarray(pairs, dtype=bool)[start:stop]
+            tasks.append((start, stop, mtau, block_pairs, batch_size))
+
+        # count
+        pool = Pool(n_jobs, initializer=_init_shared_trains,
+                    initargs=(_share_trains(sts1), _share_trains(sts2)))
+        try:
+            blocks = pool.map(_coincidence_rows, tasks)
+        finally:
+            pool.terminate()
+        if len(blocks) == 0:
+            return sp.zeros((n, m, nt), dtype=int)
+        return sp.concatenate(blocks)
+
+    @staticmethod
+    def similarity_chunked(sts1, sts2, mtau, chunk_size, prefilter=False,
+                           bin_size=None):
+        """calculates xcorr functions between all pairs of spike trains from
+        sts1 and sts2 chunk by chunk
+
+        The spikes of sts2 are processed in chunks of chunk_size together with
+        the spikes of sts1 within +/-mtau of the chunk, so only one chunk of
+        the spike trains is merged at once. This yields the same values as
+        :similarity_tensor:.
+
+        :type sts1: list
+        :param sts1: list of n sorted spike trains
+        :type sts2: list
+        :param sts2: list of m sorted spike trains
+        :type mtau: int
+        :param mtau: maximum shift
+        :type chunk_size: int
+        :param chunk_size: length of a chunk in samples
+        :type prefilter: bool
+        :param prefilter: if True, compute only the candidate pairs of every
+            chunk, see :candidate_pairs:.
+            Default=False
+        :type bin_size: int
+        :param bin_size: bin size for the prefilter.
+            Default=None
+        :returns: tuple: [n, m, 2*mtau+1] xcorr function of every pair and the
+            [n, m] bool candidate pairs of any chunk, or None without prefilter
+        """
+
+        # init
+        n, m, nt = len(sts1), len(sts2), 2 * mtau + 1
+        n1 = sp.array([st.size for st in sts1], dtype=int)
+        n2 = sp.array([st.size for st in sts2], dtype=int)
+        counts = sp.zeros((n, m, nt), dtype=int)
+        pairs = None
+        if prefilter is True:
+            pairs = sp.zeros((n, m), dtype=bool)
+        bounds = [(st[0], st[-1]) for st in sts2 if st.size > 0]
+
+        # chunks
+        if len(bounds) > 0:
+            t_start = min([b[0] for b in bounds])
+            t_stop = max([b[1] for b in bounds])
+            for t0 in sp.arange(t_start, t_stop + 1, chunk_size):
+                t1 = t0 + chunk_size
+                win1 = [st[sp.searchsorted(st, t0 - mtau, 'left'):
+                           sp.searchsorted(st, t1 + mtau, 'left')]
+                        for st in sts1]
+                win2 = [st[sp.searchsorted(st, t0, 'left'):
+                           sp.searchsorted(st, t1, 'left')]
+                        for st in sts2]
+                chunk_pairs = None
+                if prefilter is True:
+                    chunk_pairs = ModMetricFranke.candidate_pairs(
+                        win1, win2, mtau, bin_size=bin_size)
+                    pairs |= chunk_pairs
+                counts += ModMetricFranke.coincidences(
+                    win1, win2, mtau, pairs=chunk_pairs)
+
+        # normalise
+        norm = sp.maximum(n1[:, None] + n2[None, :], 1)[:, :, None]
+        return 2.0 * counts / norm, pairs
 
     @staticmethod
     def simi_kernel(s1, s2):
@@ -513,40 +1580,119 @@ class ModMetricFranke(BaseModule):
     @staticmethod
     def overlaps(sts, window):
         """Calculates a "boolean" dictonary, indicating for every spike in
-        every spiketrain in sts whether it belongs to an overlap or not"""
-        n = len(sts)
+        every spiketrain in sts whether it belongs to an overlap or not
+
+        All spikes are merged into one time sorted stream (ties ordered by
+        descending unit index) and a spike is marked, if a spike of another
+        unit lies closer than :window: and does not precede the previous
+        spike of its own unit in the stream. This marks exactly the spikes
+        that a pairwise two pointer walk over all pairs of spike trains would
+        find overlapping.
+        """
+
+        # init
+        keys = sts.keys()
+        flags = ModMetricFranke.overlap_flags([sts[k] for k in keys], window)
         O = {}
-        for k in sts.keys():
-            O[k] = sp.zeros(sts[k].shape, dtype=sp.bool_)
-        Onums = sp.zeros(len(sts))
-        # run over all pairs of spike trains in G
-        for i in xrange(n):
-            for j in xrange(i + 1, n):
-                # for every pair run over all spikes in i and check whether a
-                # spike in j overlaps
-                trainI = sts[sts.keys()[i]]
-                trainJ = sts[sts.keys()[j]]
-                idxI = 0
-                idxJ = 0
-                while idxI < len(trainI) and idxJ < len(trainJ):
-                    # Overlapping?
-                    if abs(trainI[idxI] - trainJ[idxJ]) < window:
-                        # Every spike can only be in one or no overlap.
-                        # prevents triple counting
-                        if O[sts.keys()[i]][idxI] == 0:
-                            O[sts.keys()[i]][idxI] = 1
-                            Onums[i] += 1
-                        if O[sts.keys()[j]][idxJ] == 0:
-                            O[sts.keys()[j]][idxJ] = 1
-                            Onums[j] += 1
-
-                    if trainI[idxI] < trainJ[idxJ]:
-                        idxI += 1
-                    else:
-                        idxJ += 1
+        Onums = sp.zeros(len(keys))
+        for i, k in enumerate(keys):
+            O[k] = flags[i]
+            Onums[i] = O[k].sum()
         ret = {'O': O, 'Onums': Onums}
         return ret
 
+    @staticmethod
+    def overlap_flags(trains, window):
+        """marks the overlapping spikes of a list of spike trains, see
+        :overlaps:
+
+        :type trains: list
+        :param trains: list of n sorted spike trains, ties in the stream are
+            ordered by descending list index
+        :type window: int
+        :param window: overlap distance
+        :returns: list: n bool arrays, True for the overlapping spikes
+        """
+
+        # init
+        n = len(trains)
+        trains = [sp.asarray(st) for st in trains]
+        sizes = sp.array([st.size for st in trains], dtype=int)
+        flags = [sp.zeros(st.shape, dtype=sp.bool_) for st in trains]
+        nspk = sizes.sum()
+        if nspk == 0 or n < 2 or window <= 0:
+            return flags
+        # merged stream, ties ordered by descending unit index
+        t = sp.concatenate(trains)
+        u = sp.repeat(sp.arange(n), sizes)
+        if sp.issubdtype(t.dtype, sp.integer):
+            sort_idx = sp.argsort(t.astype(sp.int64) * n + (n - 1 - u),
+                                  kind='mergesort')
+        else:
+            sort_idx = sp.lexsort((-u, t))
+        t_merged, u_merged = t[sort_idx], u[sort_idx]
+        pos = sp.empty(nspk, dtype=int)
+        pos[sort_idx] = sp.arange(nspk)
+
+        # window [lo, hi) of every spike in the stream, starting after the
+        # previous spike of its own unit
+        prev_pos = sp.empty(nspk, dtype=int)
+        prev_pos[1:] = pos[:-1]
+        prev_pos[(sp.cumsum(sizes) - sizes)[sizes > 0]] = -1
+        lo = sp.maximum(prev_pos[sort_idx] + 1,
+                        sp.searchsorted(t_merged, t_merged - window, 'right'))
+        hi = sp.searchsorted(t_merged, t_merged + window, 'left')
+
+        # overlap, if the window is not a single run of the own unit
+        run_end = sp.append(sp.flatnonzero(sp.diff(u_merged)) + 1, nspk)
+        run_end = run_end[sp.searchsorted(run_end, lo, 'right')]
+        is_ovp = ~((u_merged[lo] == u_merged) & (run_end >= hi))
+        is_ovp = is_ovp[pos]
+
+        # split per unit
+        offset = 0
+        for i in xrange(n):
+            flags[i][:] = is_ovp[offset:offset + sizes[i]]
+            offset += sizes[i]
+        return flags
+
+##---FUNCTIONS
+
+# spike trains shared with the worker processes of coincidences_parallel
+_SHARED_TRAINS = {}
+
+
+def _share_trains(trains):
+    """copies a list of spike trains into one shared memory buffer
+
+    :returns: tuple: buffer, dtype string and sizes of the spike trains
+    """
+
+    sizes = [st.size for st in trains]
+    t = sp.concatenate(trains) if len(trains) > 0 else sp.zeros(0)
+    buf = RawArray('b', max(t.nbytes, 1))
+    sp.frombuffer(buf, dtype=t.dtype, count=t.size)[:] = t
+    return buf, t.dtype.str, sizes
+
+
+def _init_shared_trains(shared1, shared2):
+    """worker initializer, maps the shared spike trains"""
+
+    for name, (buf, dtype, sizes) in [('sts1', shared1), ('sts2', shared2)]:
+        t = sp.frombuffer(buf, dtype=dtype, count=sum(sizes))
+        offsets = sp.concatenate(([0], sp.cumsum(sizes))).astype(int)
+        _SHARED_TRAINS[name] = [t[offsets[i]:offsets[i + 1]]
+                                for i in xrange(len(sizes))]
+
+
+def _coincidence_rows(task):
+    """worker task, counts the coincidences of the rows [start, stop)"""
+
+    start, stop, mtau, pairs, batch_size = task
+    return ModMetricFranke.coincidences(
+        _SHARED_TRAINS['sts1'][start:stop], _SHARED_TRAINS['sts2'], mtau,
+        pairs=pairs, batch_size=batch_size)
+
 ##--- MAIN
 
 if __name__ == '__main__':
@@ -15,10 +15,12 @@ __all__ = ['ModMetricMeila']
 
 ##--- IMPORTS
 
+import time
 import scipy as sp
+from scipy import sparse
 from .base_module import BaseModule, ModuleInputError, ModuleExecutionError
 from .result_types import MRScalar
-from ..util import dict_arrsort, dict_list2arr, matrix_argmax
+from ..util import SpikeTrainSet
 
 ##---CLASSES
 
@@ -30,7 +32,12 @@ class ModMetricMeila(BaseModule):
     self.sts_ev contains the sorted spike trains - given the
     real/ideal/ground truth spike trains in self.sts_gt
 
-    <description of method>
+    The spikes of both spike train sets are matched within a jitter window
+    and counted in the confusion matrix of the ground truth units against
+    the evaluated units. Ground truth spikes without a matching spike are
+    counted in an extra column, evaluated spikes without a matching spike in
+    an extra row. The result is the variation of information (VI) between
+    the two clusterings of all spikes, 0.0 for identical spike train sets.
 
     :Parameters:
         self.sts_gt : dict of ndarray
@@ -39,6 +46,13 @@ class ModMetricMeila(BaseModule):
         self.sts_ev : dict of ndarray
             dict containing 1d ndarrays/lists of integers, representing the
             single unit spike trains. this is the estimation.
+        maxjitter : int
+            maximal distance of two matching spikes in samples.
+            Default=6
+        sparse : bool
+            if True, the confusion matrix is built as a sparse matrix, if
+            None it is sparse for more than SPARSE_SIZE entries.
+            Default=None
     """
 
     # module interface
@@ -47,82 +61,113 @@ class ModMetricMeila(BaseModule):
         MRScalar, # result
     ]
 
+    SPARSE_SIZE = 10000
+
     def _check_sts_gt(self, sts_gt):
         if sts_gt is None:
             raise ModuleInputError('sts_gt: '
                                    'needs ground truth spike train set')
-        dict_list2arr(sts_gt)
-        dict_arrsort(sts_gt)
-        return sts_gt
+        return SpikeTrainSet(sts_gt)
 
     def _check_sts_ev(self, sts_ev):
         if sts_ev is None:
             raise ModuleInputError('sts_ev: '
                                    'needs evaluation spike train set')
-        dict_list2arr(sts_ev)
-        dict_arrsort(sts_ev)
-        return sts_ev
+        return SpikeTrainSet(sts_ev)
 
     def _check_parameters(self, parameters):
+        if parameters.get('maxjitter', 6) < 0:
+            raise ModuleInputError('maxjitter: must not be negative')
         return {
             'sampling_rate': parameters.get('sampling_rate', 32000.0),
-            'name': parameters.get('name', 'noname'), }
+            'name': parameters.get('name', 'noname'),
+            'maxjitter': parameters.get('maxjitter', 6),
+            'sparse': parameters.get('sparse', None), }
 
     def _apply(self):
         # init and checks
         n = len(self.sts_gt)
         m = len(self.sts_ev)
-        rval = 0.0
-
+        use_sparse = self.parameters['sparse']
+        if use_sparse is None:
+            use_sparse = (n + 1) * (m + 1) > self.SPARSE_SIZE
+
+        self.logger.log("confusion matrix")
+        tic = time.time()
+        confmx = ModMetricMeila.confmx(
+            self.sts_gt, self.sts_ev, self.parameters['maxjitter'],
+            use_sparse=use_sparse)
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
+
+        self.logger.log("variation of information")
+        tic = time.time()
+        rval = ModMetricMeila.vi_metric(confmx)
+        self.logger.log("VI: {} MI: {} Hx: {} Hy: {}".format(
+            rval['VI'], rval['MI'], rval['Hx'], rval['Hy']))
+        self.logger.log("duration: {:05f}s".format(time.time() - tic))
 
         # return results
         self.result = [
-            MRScalar(rval), # result
+            rval['VI'], # result
         ]
 
     @staticmethod
     def entropy(x):
         """compute entropy of a discrete random variable"""
 
-        return -sp.nansum(x * sp.log(x))
+        x = sp.asarray(x, dtype=float)
+        x = x[x > 0]
+        return -sp.sum(x * sp.log(x))
 
     @staticmethod
     def mutual_information(x, y, xy):
-        """compute mutual information between the associated random variables"""
-
-        # init
-        MI = sp.zeros(x.size, y.size)
-
-        for i in xrange(x.size):
-            for j in xrange(y.size):
-                MI[i, j] = xy[i, j] * sp.log(xy[i, j] / (x[i] * y[j]))
+        """compute mutual information between the associated random variables
+
+        :type x: ndarray
+        :param x: marginal distribution of the first variable
+        :type y: ndarray
+        :param y: marginal distribution of the second variable
+        :type xy: ndarray or sparse matrix
+        :param xy: joint distribution, only the non zero entries contribute
+        """
+
+        if sparse.issparse(xy):
+            xy = xy.tocoo()
+            rows, cols, pxy = xy.row, xy.col, xy.data
+        else:
+            xy = sp.asarray(xy, dtype=float)
+            rows, cols = sp.nonzero(xy)
+            pxy = xy[rows, cols]
+        nz = pxy > 0
+        rows, cols, pxy = rows[nz], cols[nz], pxy[nz]
 
         # return
-        return sp.nansum(MI)
+        return sp.sum(pxy * sp.log(pxy / (x[rows] * y[cols])))
 
     @staticmethod
     def vi_metric(confmx):
-        """computes Marina Meila's variation of information metric between two clusterings of the same data"""
+        """computes Marina Meila's variation of information metric between two clusterings of the same data
+
+        :type confmx: ndarray or sparse matrix
+        :param confmx: confusion matrix of the two clusterings
+        """
 
         # init
         rval = {'MI': None, 'VI': None, 'Px': None, 'Py': None, 'Pxy': None, 'Hx': None, 'Hy': None}
-        nx, ny = confmx.shape
-        Px = sp.zeros(nx)
-        Py = sp.zeros(ny)
+        if not sparse.issparse(confmx):
+            confmx = sp.asarray(confmx, dtype=float)
 
         # compute
-        tot = sp.nansum(confmx)
-        for i in xrange(nx):
-            Px[i] = confmx[i, :].sum() / tot
-        for j in xrange(ny):
-            Py[j] = confmx[:, j].sum() / tot
-        Pxy = confmx / tot
+        tot = float(confmx.sum())
+        Px = sp.asarray(confmx.sum(axis=1), dtype=float).ravel() / tot
+        Py = sp.asarray(confmx.sum(axis=0), dtype=float).ravel() / tot
+        Pxy = confmx * (1.0 / tot)
         Hx = ModMetricMeila.entropy(Px)
         Hy = ModMetricMeila.entropy(Py)
         MI = ModMetricMeila.mutual_information(Px, Py, Pxy)
 
         # return
-        rval['VI'] = Hx + Hy - 2 * MI
+        rval['VI'] = max(Hx + Hy - 2 * MI, 0.0)
         rval['MI'] = MI
         rval['Pxy'] = Pxy
         rval['Px'] = Px
@@ -132,10 +177,102 @@ class ModMetricMeila(BaseModule):
         return rval
 
     @staticmethod
-    def confmx(gt, ev):
-        """returns confusion matrix of sorting A and B"""
+    def confmx(gt, ev, jitter=6, use_sparse=False):
+        """returns confusion matrix of sorting A and B
+
+        The spikes are matched one to one on the time sorted spike streams
+        of both spike train sets, see :match_spikes:. Row n counts the
+        unmatched spikes of ev, column m the unmatched spikes of gt.
+
+        :type gt: SpikeTrainSet
+        :param gt: spike train set with n units
+        :type ev: SpikeTrainSet
+        :param ev: spike train set with m units
+        :type jitter: int
+        :param jitter: maximal distance of two matching spikes
+        :type use_sparse: bool
+        :param use_sparse: if True, return a sparse csr matrix
+        :returns: ndarray or csr_matrix: confusion matrix with shape (n+1,
+            m+1)
+        """
 
-        pass
+        # init
+        gt, ev = SpikeTrainSet(gt), SpikeTrainSet(ev)
+        n, m = len(gt), len(ev)
+        times1, units1 = gt.merged()
+        times2, units2 = ev.merged()
+        idx1, idx2 = ModMetricMeila.match_spikes(times1, times2, jitter)
+        free1 = sp.ones(times1.size, dtype=bool)
+        free1[idx1] = False
+        free2 = sp.ones(times2.size, dtype=bool)
+        free2[idx2] = False
+
+        # count
+        rows = sp.concatenate((units1[idx1], units1[free1],
+                               sp.ones(free2.sum(), dtype=int) * n))
+        cols = sp.concatenate((units2[idx2], sp.ones(free1.sum(), dtype=int) * m,
+                               units2[free2]))
+        if use_sparse is True:
+            return sparse.coo_matrix(
+                (sp.ones(rows.size), (rows, cols)),
+                shape=(n + 1, m + 1)).tocsr()
+        return sp.bincount(rows * (m + 1) + cols,
+                           minlength=(n + 1) * (m + 1)).reshape(
+            n + 1, m + 1).astype(float)
+
+    @staticmethod
+    def match_spikes(times1, times2, jitter):
+        """one to one matching of two sorted spike time arrays
+
+        In every round each unmatched spike of times1 is paired with the
+        closest unmatched spike of times2 within +/-jitter. A spike of times2
+        claimed more than once goes to the closest claiming spike, the others
+        try again in the next round, until no pair is left.
+
+        :type times1: ndarray
+        :param times1: sorted spike times
+        :type times2: ndarray
+        :param times2: sorted spike times
+        :type jitter: int
+        :param jitter: maximal distance of two matching spikes
+        :returns: tuple: index arrays into times1 and times2 of the matched
+            spikes
+        """
+
+        # init
+        free1 = sp.ones(times1.size, dtype=bool)
+        free2 = sp.ones(times2.size, dtype=bool)
+        idx1, idx2 = [sp.zeros(0, dtype=int)], [sp.zeros(0, dtype=int)]
+
+        while True:
+            cand1 = sp.flatnonzero(free1)
+            cand2 = sp.flatnonzero(free2)
+            if cand1.size == 0 or cand2.size == 0:
+                break
+            t1, t2 = times1[cand1], times2[cand2]
+            pos = sp.searchsorted(t2, t1)
+            left = sp.clip(pos - 1, 0, t2.size - 1)
+            right = sp.clip(pos, 0, t2.size - 1)
+            dleft = sp.absolute(t1 - t2[left])
+            dright = sp.absolute(t2[right] - t1)
+            near = sp.where(dright < dleft, right, left)
+            dist = sp.minimum(dleft, dright)
+            ok = dist <= jitter
+            if not ok.any():
+                break
+            a, b, dist = cand1[ok], cand2[near[ok]], dist[ok]
+            # the closest claiming spike wins, ties go to the earlier spike
+            order = sp.lexsort((a, dist, b))
+            a, b = a[order], b[order]
+            first = sp.concatenate(([True], b[1:] != b[:-1]))
+            a, b = a[first], b[first]
+            free1[a] = False
+            free2[b] = False
+            idx1.append(a)
+            idx2.append(b)
+
+        # return
+        return sp.concatenate(idx1), sp.concatenate(idx2)
 
 ##--- MAIN
 
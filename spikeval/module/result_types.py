@@ -14,6 +14,7 @@ __all__ = ['ResultError', 'ModuleResult', 'MRString', 'MRScalar', 'MRTable',
 
 ##---IMPORTS
 
+from collections import Mapping
 import scipy as sp
 from texttable import Texttable
 import Image
@@ -137,13 +138,17 @@ class MRDict(ModuleResult):
 
     def __init__(self, init_values):
         """
-        :type init_values: list
-        :param init_values: list of tuples to initialise a dictionary from
+        :type init_values: list or Mapping
+        :param init_values: list of tuples to initialise a dictionary from,
+            a Mapping is kept as it is without copying
         """
 
         super(MRDict, self).__init__()
 
-        self._value = dict(init_values)
+        if isinstance(init_values, Mapping):
+            self._value = init_values
+        else:
+            self._value = dict(init_values)
 
     @property
     def shape(self):
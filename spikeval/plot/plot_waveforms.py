@@ -14,12 +14,14 @@ __all__ = ['waveforms']
 ##---IMPORTS
 
 import scipy as sp
+from matplotlib.collections import LineCollection
 from .common import COLOURS, gen_fig
 
 ##---FUNCTION
 
 def waveforms(waveforms, samples_per_second=None, tf=None, plot_mean=False, plot_single_waveforms=True,
-              set_y_range=False, plot_separate=True, templates=None, colours=None, title=None):
+              set_y_range=False, plot_separate=True, templates=None, colours=None, title=None,
+              counts=None):
     """plot one set of spiketrains or two sets of spkitrains with their
     interspike alignment
 
@@ -44,6 +46,9 @@ def waveforms(waveforms, samples_per_second=None, tf=None, plot_mean=False, plot
         None the common.plot.COLORS set is used.
     :type title: str
     :param title: Title for the plot. No title if None or ''.
+    :type counts: dict
+    :param counts: event count per key for the axis labels, if the waveforms
+        are a subsample. If None the number of waveforms is used.
     :rtype: matplotlib.figure.Figure
     """
 
@@ -86,12 +91,18 @@ def waveforms(waveforms, samples_per_second=None, tf=None, plot_mean=False, plot
             col = col_lst[col_idx % len(col_lst)]
             if plot_mean is True:
                 col = 'gray'
-            for i in xrange(waveforms[k].shape[0]):
-                ax.plot(sp.arange(nsample) / srate, waveforms[k][i, :],
-                    color=col)
+            # one collection for all waveforms of the unit, built from the
+            # [nevent, nsample, 2] vertex array
+            segments = sp.empty((nevent, nsample, 2))
+            segments[:, :, 0] = sp.arange(nsample) / srate
+            segments[:, :, 1] = waveforms[k]
+            ax.add_collection(LineCollection(segments, colors=[col]))
+            ax.autoscale_view()
             col_idx += 1
 
             # addition: per axis event count
+            if counts is not None and k in counts:
+                nevent = counts[k]
             ax.set_ylabel('n:%s' % nevent)
 
     # plot mean waveforms
@@ -8,14 +8,360 @@
 
 """general utility/tools for dictionary and array handling"""
 __docformat__ = 'restructuredtext'
-__all__ = ['dict_list2arr', 'dict_arrsort', 'extract_spikes', 'jitter_st',
-           'jitter_sts', 'matrix_argmax', 'matrix_argmin', 'sortrows']
+__all__ = ['PairAlignment', 'RawData', 'SpikeTrainSet', 'UnitArrays',
+           'dict_list2arr', 'dict_arrsort',
+           'expand_ranges', 'extract_spikes', 'jitter_st', 'jitter_sts',
+           'matrix_argmax', 'matrix_argmin', 'ranked_pairs', 'sortrows']
 
 
 ##---IMPORTS
 
+from collections import Mapping
 import scipy as sp
+from numpy.lib.stride_tricks import as_strided
 
+EXTRACT_BATCH_SIZE = 2 ** 22
+EXTRACT_BLOCK_BYTES = 2 ** 26
+
+
+##---CLASSES
+
+class UnitArrays(Mapping):
+    """read only mapping of units to arrays, stored as one flat array
+
+    The array of the unit with key keys[i] is the view data[offsets[i]:
+    offsets[i + 1]], no per unit arrays are allocated.
+    """
+
+    def __init__(self, keys, offsets, values):
+        """
+        :type keys: list
+        :param keys: unit keys, in order
+        :type offsets: ndarray
+        :param offsets: [len(keys) + 1] start of every unit in values
+        :type values: ndarray
+        :param values: values of all units, ordered by unit
+        """
+
+        self._keys = list(keys)
+        self.offsets = sp.asarray(offsets, dtype=int)
+        self.data = sp.asarray(values)
+        self._index = dict([(k, i) for i, k in enumerate(self._keys)])
+        if self.offsets.size != len(self._keys) + 1:
+            raise ValueError('offsets must have one entry more than keys')
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    @property
+    def sizes(self):
+        """number of values per unit"""
+
+        return sp.diff(self.offsets)
+
+    @property
+    def units(self):
+        """unit index of every value"""
+
+        return sp.repeat(sp.arange(len(self._keys)), self.sizes)
+
+
+class SpikeTrainSet(UnitArrays):
+    """spike train set, stored as one array of spike times
+
+    The spike times of all units are stored in one int64 array, grouped by
+    unit in a stable key order and sorted within every unit, together with
+    the unit index of every spike and the unit offsets. If not all spike
+    times are integral, they are stored as float64. The set behaves like a
+    read only dict of spike trains, the spike train of a unit is a view
+    into the spike time array.
+    """
+
+    def __init__(self, sts, dtype=None):
+        """
+        :type sts: dict or SpikeTrainSet
+        :param sts: spike train set, dict of 1d arrays/lists of spike times.
+            The key order of sts is kept.
+        :type dtype: dtype
+        :param dtype: if not None, dtype of the spike times.
+            Default=None
+        """
+
+        # init
+        if isinstance(sts, SpikeTrainSet) and dtype in [None, sts.data.dtype]:
+            keys, offsets, data = sts.keys(), sts.offsets, sts.data
+        else:
+            keys = list(sts.keys())
+            trains = [sp.asarray(sts[k]).ravel() for k in keys]
+            offsets = sp.concatenate(
+                ([0], sp.cumsum([st.size for st in trains]))).astype(int)
+            data = sp.concatenate(trains + [sp.zeros(0, dtype=sp.int64)])
+            if dtype is None:
+                dtype = sp.float64
+                if sp.issubdtype(data.dtype, sp.integer) or\
+                   (data == sp.floor(data)).all():
+                    dtype = sp.int64
+            data = data.astype(dtype)
+        super(SpikeTrainSet, self).__init__(keys, offsets, data)
+        self._unit_index = sp.repeat(sp.arange(len(keys)), self.sizes)
+
+        # sort within units
+        unsorted = (sp.diff(self.data) < 0) & \
+                   (self.unit_index[1:] == self.unit_index[:-1])
+        if unsorted.any():
+            self.data = self.data[sp.lexsort((self.data, self.unit_index))]
+        self._merged = None
+
+    @property
+    def unit_index(self):
+        """unit index of every spike, built on first use"""
+
+        if self._unit_index is None:
+            self._unit_index = sp.repeat(sp.arange(len(self._keys)),
+                                         self.sizes)
+        return self._unit_index
+
+    @property
+    def units(self):
+        """unit index of every spike"""
+
+        return self.unit_index
+
+    def merged(self):
+        """time sorted view of all spikes, ties ordered by unit
+
+        :returns: tuple: spike times and unit indices
+        """
+
+        if self._merged is None:
+            sort_idx = sp.argsort(self.data, kind='mergesort')
+            self._merged = self.data[sort_idx], self.unit_index[sort_idx]
+        return self._merged
+
+    def shifted(self, delta):
+        """returns the spike train set with every unit shifted
+
+        :type delta: ndarray
+        :param delta: shift per unit
+        :returns: SpikeTrainSet: shifted spike train set, int64 if the spike
+            times and shifts are integral
+        """
+
+        delta = sp.asarray(delta)
+        if sp.issubdtype(self.data.dtype, sp.integer) and\
+           (delta == sp.floor(delta)).all():
+            delta = delta.astype(sp.int64)
+        rval = SpikeTrainSet.__new__(SpikeTrainSet)
+        UnitArrays.__init__(rval, self.keys(), self.offsets,
+                            self.data + sp.repeat(delta, self.sizes))
+        rval._unit_index = self._unit_index
+        rval._merged = None
+        return rval
+
+    @staticmethod
+    def from_arrays(keys, offsets, data):
+        """builds a spike train set from arrays in the internal layout
+
+        :type keys: list
+        :param keys: unit keys
+        :type offsets: ndarray
+        :param offsets: start of every unit in data, plus the total size
+        :type data: ndarray
+        :param data: spike times grouped by unit and sorted within every unit
+        :returns: SpikeTrainSet: spike train set using data without copying,
+            data may be a memmap
+        """
+
+        rval = SpikeTrainSet.__new__(SpikeTrainSet)
+        UnitArrays.__init__(rval, keys, offsets, data)
+        rval._unit_index = None
+        rval._merged = None
+        return rval
+
+    def to_dict(self):
+        """returns a dict of spike train copies"""
+
+        return dict([(k, self[k].copy()) for k in self.keys()])
+
+
+class PairAlignment(Mapping):
+    """read only mapping of pairs of units to their aligned spikes
+
+    The index arrays of the aligned spikes of all pairs are stored as two
+    int32 arrays, grouped by pair with CSR style offsets, for the pairs
+    with aligned spikes only. For compatibility every pair (key1, key2) maps
+    to the list of (idx1, idx2) tuples, which is built on access, see
+    :arrays: for the index arrays.
+    """
+
+    def __init__(self, keys1, keys2, pairs, offsets, idx1, idx2):
+        """
+        :type keys1: list
+        :param keys1: keys of the first units
+        :type keys2: list
+        :param keys2: keys of the second units
+        :type pairs: ndarray
+        :param pairs: [p, 2] unit indices (i, j) of the pairs with aligned
+            spikes
+        :type offsets: ndarray
+        :param offsets: [p + 1] start of every pair in idx1 and idx2
+        :type idx1: ndarray
+        :param idx1: spike indices in the first units
+        :type idx2: ndarray
+        :param idx2: spike indices in the second units
+        """
+
+        self.keys1 = list(keys1)
+        self.keys2 = list(keys2)
+        self.pairs = sp.asarray(pairs, dtype=int).reshape(-1, 2)
+        self.offsets = sp.asarray(offsets, dtype=int)
+        self.idx1 = sp.asarray(idx1, dtype=sp.int32)
+        self.idx2 = sp.asarray(idx2, dtype=sp.int32)
+        self._index1 = dict([(k, i) for i, k in enumerate(self.keys1)])
+        self._index2 = dict([(k, j) for j, k in enumerate(self.keys2)])
+        self._pos = dict([((i, j), p)
+                          for p, (i, j) in enumerate(self.pairs.tolist())])
+
+    @staticmethod
+    def from_aligned(keys1, keys2, aligned):
+        """builds the alignment from a dict of index arrays (idx1, idx2) per
+        pair of unit indices (i, j)"""
+
+        pairs = sorted([p for p in aligned if aligned[p][0].size > 0])
+        sizes = [aligned[p][0].size for p in pairs]
+        return PairAlignment(
+            keys1, keys2, pairs,
+            sp.concatenate(([0], sp.cumsum(sizes))),
+            sp.concatenate([aligned[p][0] for p in pairs] + [[]]),
+            sp.concatenate([aligned[p][1] for p in pairs] + [[]]))
+
+    def arrays(self, key):
+        """index arrays (idx1, idx2) of the aligned spikes of a pair"""
+
+        i, j = self._index1[key[0]], self._index2[key[1]]
+        p = self._pos.get((i, j), None)
+        if p is None:
+            return self.idx1[:0], self.idx2[:0]
+        start, stop = self.offsets[p], self.offsets[p + 1]
+        return self.idx1[start:stop], self.idx2[start:stop]
+
+    def __getitem__(self, key):
+        idx1, idx2 = self.arrays(key)
+        return zip(idx1.tolist(), idx2.tolist())
+
+    def __iter__(self):
+        for k1 in self.keys1:
+            for k2 in self.keys2:
+                yield k1, k2
+
+    def __len__(self):
+        return len(self.keys1) * len(self.keys2)
+
+
+class RawData(object):
+    """lazy raw data with [samples, channels], read on demand
+
+    Subclasses provide the data source by implementing :_read:, which
+    returns the samples [start, stop) of the selected channels. All reads
+    return float32 arrays with [samples, channels]. A :RawData: can be used
+    in place of a raw data ndarray, see :extract_spikes:.
+    """
+
+    ndim = 2
+    dtype = sp.dtype(sp.float32)
+
+    def __init__(self, shape):
+        """
+        :type shape: tuple
+        :param shape: (samples, channels)
+        """
+
+        self.shape = tuple(map(int, shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, channels = key
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step > 0:
+                return self.read(start, max(start, stop), channels)[::step]
+            return self[:, channels][rows]
+        rows = int(rows)
+        if rows < 0:
+            rows += self.shape[0]
+        if not 0 <= rows < self.shape[0]:
+            raise IndexError('sample index out of range')
+        return self.read(rows, rows + 1, channels)[0]
+
+    def __array__(self, dtype=None):
+        rval = self.to_array()
+        if dtype is not None:
+            rval = rval.astype(dtype)
+        return rval
+
+    def read(self, start=0, stop=None, channels=None):
+        """read the samples [start, stop) of :channels:
+
+        :type start: int
+        :param start: first sample, clipped to the data
+        :type stop: int
+        :param stop: sample after the last, clipped to the data, None for the
+            end of the data
+        :type channels: slice or list or None
+        :param channels: channel selection, None for all channels
+        :returns: ndarray: float32 data [samples, channels]
+        """
+
+        start = min(max(int(start), 0), self.shape[0])
+        stop = self.shape[0] if stop is None else int(stop)
+        stop = min(max(stop, start), self.shape[0])
+        if channels is None:
+            channels = slice(None)
+        return sp.asarray(self._read(start, stop, channels), dtype=sp.float32)
+
+    def iter_chunks(self, chunk_size, channels=None):
+        """iterates over the data in chunks of samples
+
+        :type chunk_size: int
+        :param chunk_size: number of samples per chunk
+        :type channels: slice or list or None
+        :param channels: channel selection, None for all channels
+        :returns: generator: yields the start sample and the float32 data of
+            every chunk
+        """
+
+        for start in xrange(0, self.shape[0], chunk_size):
+            yield start, self.read(start, start + chunk_size, channels)
+
+    def to_array(self, chunk_size=2 ** 16):
+        """reads all data into one C contiguous float32 array, chunk by chunk
+
+        :type chunk_size: int
+        :param chunk_size: number of samples per chunk
+        :returns: ndarray: float32 data [samples, channels]
+        """
+
+        rval = sp.empty(self.shape, dtype=sp.float32)
+        for start, chunk in self.iter_chunks(chunk_size):
+            rval[start:start + chunk.shape[0]] = chunk
+        return rval
+
+    def _read(self, start, stop, channels):
+        raise NotImplementedError
 
 ##---FUNCTIONS
 
@@ -52,33 +398,117 @@ def dict_arrsort(in_dict):
         return in_dict
 
 
-def extract_spikes(data, epochs):
+def expand_ranges(lo, hi):
+    """expand a set of index ranges [lo, hi) into flat index arrays
+
+    For every range i, all indices lo[i] <= idx < hi[i] are produced, together
+    with the number of the range they belong to. Empty ranges yield nothing.
+
+    :type lo: ndarray
+    :param lo: start indices of the ranges (inclusive)
+    :type hi: ndarray
+    :param hi: end indices of the ranges (exclusive)
+    :returns: tuple of ndarray: range number and index for each expanded item
+    """
+
+    lo = sp.asarray(lo, dtype=int)
+    cnt = sp.maximum(sp.asarray(hi, dtype=int) - lo, 0)
+    owner = sp.repeat(sp.arange(cnt.size), cnt)
+    idx = sp.arange(cnt.sum()) - sp.repeat(sp.cumsum(cnt) - cnt - lo, cnt)
+    return owner, idx
+
+
+def extract_spikes(data, epochs, out=None, batch_size=None,
+                   block_size=None):
     """extract spike waveforms according to :epochs: from :data:
 
-    :type data: ndarray
+    The waveforms are gathered in batches of spikes, epochs within the data
+    are copied from a strided window view on :data:, epochs reaching over
+    the data edges are zero padded.
+
+    For lazy data, a :RawData: (e.g. HDF5RawData for an HDF5 node) or a
+    memmap, the epochs are sorted and grouped into contiguous blocks of
+    samples. Every block is read once and the waveforms are returned in the
+    order of :epochs:.
+
+    :type data: ndarray or RawData
     :param data: the signal to extract from [samples, channels]
     :type epochs: ndarray
     :param epochs: epochs to cut [[start,end]], should have common length!
-    :type mc: bool
+    :type out: ndarray
+    :param out: if not None, C contiguous output array [ns, tf * nc] with
+        the dtype of data, which is filled and returned
+        Default=None
+    :type batch_size: int
+    :param batch_size: number of spikes per batch, None for batches of about
+        EXTRACT_BATCH_SIZE samples
+        Default=None
+    :type block_size: int
+    :param block_size: for lazy data, maximal number of samples per block,
+        None for blocks of about EXTRACT_BLOCK_BYTES
+        Default=None
     :returns: ndarray, extracted spike waveforms from :data:
     """
 
     # inits and checks
-    if not all(map(isinstance, [data, epochs], [sp.ndarray] * 2)):
+    if not isinstance(data, (sp.ndarray, RawData)) or\
+       not isinstance(epochs, sp.ndarray):
         raise TypeError('pass sp.ndarrays!')
     ns, nc = epochs.shape[0], data.shape[1]
     if epochs.shape[0] == 0:
         return sp.zeros((0, 0))
     tf = epochs[0, 1] - epochs[0, 0]
+    if out is None:
+        out = sp.empty((ns, tf * nc), dtype=data.dtype)
+    if out.shape != (ns, tf * nc) or not out.flags.c_contiguous:
+        raise ValueError('out must be a C contiguous array of shape %s' %
+                         ((ns, tf * nc),))
+    rval = out
 
     # extract
-    rval = sp.zeros((ns, tf * nc), dtype=data.dtype)
-    for s in xrange(ns):
-        for c in xrange(nc):
-            correct_beg = min(0, epochs[s, 0])
-            correct_end = max(0, epochs[s, 1] - data.shape[0])
-            rval[s, c * tf - correct_beg:(c + 1) * tf - correct_end] =\
-            data[epochs[s, 0] - correct_beg:epochs[s, 1] - correct_end, c]
+    n = data.shape[0]
+    if batch_size is None:
+        batch_size = max(EXTRACT_BATCH_SIZE // max(tf * nc, 1), 1)
+    if isinstance(data, (RawData, sp.memmap)):
+        if block_size is None:
+            block_size = EXTRACT_BLOCK_BYTES // (nc * data.dtype.itemsize)
+        block_size = max(block_size, tf)
+        order = sp.argsort(epochs[:, 0], kind='mergesort')
+        starts = epochs[order, 0]
+        i = 0
+        while i < ns:
+            # all epochs starting within block_size - tf samples of the first
+            lo = max(starts[i], 0)
+            j = max(sp.searchsorted(starts, lo + block_size - tf, 'right'),
+                    i + 1)
+            hi = min(starts[j - 1] + tf, n)
+            if isinstance(data, RawData):
+                chunk = data.read(lo, hi)
+            else:
+                chunk = sp.asarray(data[lo:max(lo, hi)])
+            for k in xrange(i, j, batch_size):
+                rows = order[k:min(k + batch_size, j)]
+                rval[rows] = extract_spikes(chunk, epochs[rows] - lo)
+            i = j
+        return rval
+    windows = None
+    if n >= tf:
+        # windows[t] is the view on data[t:t + tf]
+        windows = as_strided(data, shape=(n - tf + 1, tf, nc),
+                             strides=(data.strides[0],) + data.strides)
+    for b in xrange(0, ns, batch_size):
+        start = epochs[b:b + batch_size, 0].astype(int)
+        # [spikes, channels, samples] view on the output rows of the batch
+        wf = rval[b:b + start.size].reshape(start.size, nc, tf)
+        inner = (start >= 0) & (start + tf <= n)
+        if inner.any():
+            wf[inner] = windows[start[inner]].transpose(0, 2, 1)
+        if not inner.all():
+            idx = start[~inner, None] + sp.arange(tf)[None, :]
+            valid = (idx >= 0) & (idx < n)
+            edge = sp.zeros(idx.shape + (nc,), dtype=rval.dtype)
+            edge[valid] = data[idx[valid]]
+            wf[~inner] = edge.transpose(0, 2, 1)
     return rval
 
 
@@ -157,6 +587,23 @@ def matrix_argmin(M):
     return i, j
 
 
+def ranked_pairs(M):
+    """returns the indices (row,col) of all entries in M, ordered by
+    descending value
+
+    Ties are broken in row major order, so the result equals repeatedly
+    taking the argmax of M and masking the found entry.
+
+    :type M: ndarray
+    :param M: matrix
+    :returns: ndarray: [M.size, 2] indices (row,col) of the entries in M
+    """
+
+    M = sp.asarray(M)
+    idx = sp.argsort(-M.ravel(), kind='mergesort')
+    return sp.vstack(sp.unravel_index(idx, M.shape)).T
+
+
 def sortrows(data):
     """sort matrix by rows
 
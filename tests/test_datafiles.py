@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# tests - test_datafiles.py
+#
+# Philipp Meier - <pmeier82 at gmail dot com>
+# 2011-10-11
+#
+
+"""unit tests for data file io"""
+__docformat__ = 'restructuredtext'
+
+
+##---IMPORTS
+
+try:
+    # for python < 2.7.x
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import os
+import shutil
+import tempfile
+import scipy as sp
+from spikeval.datafiles import *
+
+
+##---TESTS
+
+class TestDatafiles(unittest.TestCase):
+    """test case for data file io"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gdf = os.path.join(self.tmp_dir, 'sts.gdf')
+        with open(self.gdf, 'w') as gdf:
+            gdf.write('00002\t15\n1 3\n\n1 2 3\nbad\n00002  4\r\n'
+                      'unit_no_seven\t+8\n1\t5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_gdf_sts(self):
+        for block_size in [1, 7, 1024]:
+            sts = read_gdf_sts(self.gdf, block_size=block_size)
+            self.assertEqual(sorted(sts.keys()),
+                             ['00002', '1', 'unit_no_seven'])
+            self.assertTrue((sts['00002'] == [4, 15]).all())
+            self.assertTrue((sts['1'] == [3, 5]).all())
+            self.assertTrue((sts['unit_no_seven'] == [8]).all())
+        sts = read_gdf_sts(self.gdf, as_set=True)
+        self.assertEqual(sts.keys(), ['00002', '1', 'unit_no_seven'])
+        self.assertTrue((sts.offsets == [0, 2, 4, 5]).all())
+        blocks = list(iter_gdf_sts(self.gdf, block_size=16))
+        self.assertEqual(sum([st.size for b in blocks for st in b.values()]),
+                         5)
+
+    def test_read_gdf_sts_invalid(self):
+        with open(self.gdf, 'a') as gdf:
+            gdf.write('\n1\tx\n')
+        self.assertRaises(ValueError, read_gdf_sts, self.gdf)
+
+    def test_sts_arc(self):
+        arc = os.path.join(self.tmp_dir, 'sts.npz')
+        self.assertTrue(gdf_to_sts_arc(self.gdf, arc, srate=32000.0,
+                                       name='test'))
+        sts, metadata = read_sts_arc(arc)
+        self.assertEqual(metadata, {'srate': 32000.0, 'name': 'test'})
+        self.assertIsInstance(sts.data.base, sp.memmap)
+        sts_gdf = read_gdf_sts(self.gdf)
+        self.assertEqual(sorted(sts.keys()), sorted(sts_gdf.keys()))
+        for k in sts_gdf:
+            self.assertTrue((sts[k] == sts_gdf[k]).all())
+        gdf = os.path.join(self.tmp_dir, 'sts2.gdf')
+        self.assertTrue(sts_arc_to_gdf(arc, gdf))
+        sts_gdf2 = read_gdf_sts(gdf)
+        for k in sts_gdf:
+            self.assertTrue((sts_gdf2[k] == sts_gdf[k]).all())
+
+    def test_read_hdf5_arc_lazy(self):
+        arc = os.path.join(self.tmp_dir, 'raw.h5')
+        inp = sp.randn(4, 200)
+        self.assertTrue(create_hdf5_arc(arc, inp, srate=32000.0))
+        data, srate = read_hdf5_arc(arc)
+        self.assertEqual(srate, 32000.0)
+        self.assertEqual(data.shape, (200, 4))
+        raw_data, srate = read_hdf5_arc(arc, lazy=True)
+        self.assertIsInstance(raw_data, HDF5RawData)
+        self.assertEqual(raw_data.shape, (200, 4))
+        self.assertTrue((raw_data[50:60, 1:3] == data[50:60, 1:3]).all())
+        self.assertTrue((raw_data.read(190, 220) == data[190:]).all())
+        raw_data.close()
+
+    def test_create_hdf5_arc_blocks(self):
+        arc = os.path.join(self.tmp_dir, 'raw.h5')
+        inp = sp.randn(1000, 4)
+        blocks = (inp[i:i + 300] for i in xrange(0, 1000, 300))
+        self.assertTrue(create_hdf5_arc(arc, blocks, srate=32000.0,
+                                        chunk_samples=128))
+        data, srate = read_hdf5_arc(arc)
+        self.assertEqual(srate, 32000.0)
+        self.assertTrue((data == inp.astype(sp.float32)).all())
+        self.assertFalse(create_hdf5_arc(arc, iter([])))
+
+    def test_read_dat_arc(self):
+        dat = os.path.join(self.tmp_dir, 'raw.dat')
+        inp = sp.random.randint(-1000, 1000, (300, 4)).astype(sp.int16)
+        inp.tofile(dat)
+        raw_data, srate = read_dat_arc(dat, 4, srate=32000.0, gain=0.5,
+                                       offset=1.0)
+        self.assertEqual(srate, 32000.0)
+        self.assertEqual(raw_data.shape, (300, 4))
+        self.assertTrue((raw_data.memmap == inp).all())
+        self.assertTrue(
+            (raw_data[100:110, [1, 3]] == inp[100:110, [1, 3]] * 0.5 + 1).all())
+        self.assertEqual(raw_data[0:1].dtype, sp.float32)
+
+##---MAIN
+
+if __name__ == '__main__':
+    unittest.main()
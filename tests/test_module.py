@@ -19,8 +19,11 @@ except ImportError:
     import unittest
 
 import sys
+from StringIO import StringIO
 import scipy as sp
-from spikeval.module import ModDefault, ModMetricFranke
+from spikeval.module import (ModDefault, ModMetricFranke, ModMetricMeila,
+                             ModuleInputError)
+from spikeval.util import extract_spikes
 
 
 ##---TESTS
@@ -49,6 +52,28 @@ class TestModule(unittest.TestCase):
         mod.apply()
         self.assertEqual(mod.status, 'finalised')
 
+    def test_mod_data_plots_sampled(self):
+        mod = ModDefault(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_ev,
+            sys.stdout,
+            max_waveforms_per_unit=3)
+        mod.apply()
+        self.assertEqual(mod.status, 'finalised')
+        units = sp.array([0, 0, 0, 0, 1, 2, 2, 2, 2, 2])
+        sample = ModDefault.reservoir_sample(units, 2, seed=1)
+        self.assertTrue((sp.bincount(units[sample]) == [2, 1, 2]).all())
+        self.assertTrue(
+            (sample == ModDefault.reservoir_sample(units, 2, seed=1)).all())
+        epochs = sp.array([[100, 110], [200, 210], [300, 310]])
+        means = ModDefault.mean_waveforms(self.raw_data, epochs,
+                                          sp.array([0, 2, 0]), 3, batch_size=2)
+        waveforms = extract_spikes(self.raw_data, epochs)
+        self.assertTrue(sp.allclose(means[0], waveforms[[0, 2]].mean(axis=0)))
+        self.assertTrue((means[1] == 0).all())
+        self.assertTrue(sp.allclose(means[2], waveforms[1]))
+
     def test_metric_alignment(self):
         mod = ModMetricFranke(
             self.raw_data,
@@ -58,6 +83,204 @@ class TestModule(unittest.TestCase):
         mod.apply()
         self.assertEqual(mod.status, 'finalised')
 
+    def test_metric_alignment_similarity(self):
+        mtau = 10
+        for i in xrange(10):
+            st1 = sp.sort(sp.random.randint(0, 500, 30))
+            st2 = sp.sort(sp.random.randint(0, 500, 30))
+            sfunc = ModMetricFranke.similarity(st1, st2, mtau)
+            for tau in xrange(-mtau, mtau + 1):
+                self.assertEqual(
+                    sfunc[tau + mtau],
+                    ModMetricFranke.simi_kernel(st1, st2 + tau))
+
+    def test_metric_alignment_prefilter(self):
+        gt = [sp.array([100, 200, 300]), sp.array([5000, 6000])]
+        ev = [sp.array([103, 198]), sp.array([9000])]
+        pairs = ModMetricFranke.candidate_pairs(gt, ev, 5)
+        self.assertEqual(pairs.tolist(), [[True, False], [False, False]])
+        sfuncs = ModMetricFranke.similarity_tensor(gt, ev, 5, pairs=pairs)
+        self.assertTrue(
+            (sfuncs == ModMetricFranke.similarity_tensor(gt, ev, 5)).all())
+        mod = ModMetricFranke(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_ev,
+            sys.stdout,
+            prefilter=True)
+        mod.apply()
+        self.assertEqual(mod.status, 'finalised')
+
+    def test_metric_alignment_parallel(self):
+        gt = [sp.array([100, 200, 300]), sp.array([]), sp.array([5000, 6000]),
+              sp.array([98, 5003])]
+        ev = [sp.array([103, 198]), sp.array([9000]), sp.array([5001])]
+        sfuncs = ModMetricFranke.similarity_tensor(gt, ev, 5, n_jobs=2)
+        self.assertTrue(
+            (sfuncs == ModMetricFranke.similarity_tensor(gt, ev, 5)).all())
+        mod = ModMetricFranke(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_ev,
+            sys.stdout,
+            n_jobs=2)
+        mod.apply()
+        self.assertEqual(mod.status, 'finalised')
+
+    def test_metric_alignment_correspondence(self):
+        M = sp.array([[5, 4, 0],
+                      [4, 0, 0]])
+        u_k2f, u_f2k = ModMetricFranke.unit_correspondence(M, 'greedy')
+        self.assertEqual(u_k2f.tolist(), [0, 1])
+        self.assertEqual(u_f2k.tolist(), [0, 1, -1])
+        u_k2f, u_f2k = ModMetricFranke.unit_correspondence(M, 'optimal')
+        self.assertEqual(u_k2f.tolist(), [1, 0])
+        self.assertEqual(u_f2k.tolist(), [1, 0, -1])
+
+    def test_metric_alignment_overlaps(self):
+        sts = {0: sp.array([100, 200, 300]),
+               1: sp.array([105, 400]),
+               2: sp.array([302])}
+        ret = ModMetricFranke.overlaps(sts, 10)
+        self.assertEqual(ret['O'][0].tolist(), [True, False, True])
+        self.assertEqual(ret['O'][1].tolist(), [True, False])
+        self.assertEqual(ret['O'][2].tolist(), [True])
+        self.assertEqual(ret['Onums'].tolist(), [2, 1, 1])
+
+    def test_metric_alignment_align_spikes(self):
+        st1 = sp.array([10, 20, 30, 40])
+        st2 = sp.array([8, 11, 19, 50])
+        idx1, idx2 = ModMetricFranke.align_spikes(st1, st2, 2)
+        self.assertEqual(idx1.tolist(), [0, 1])
+        self.assertEqual(idx2.tolist(), [0, 2])
+        free1 = sp.array([False, True, True, True])
+        idx1, idx2 = ModMetricFranke.align_spikes(st1, st2, 2, free1=free1)
+        self.assertEqual(idx1.tolist(), [1])
+        self.assertEqual(idx2.tolist(), [2])
+
+    def test_metric_alignment_update(self):
+        mod = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            dict(self.sts_ev),
+            sys.stdout)
+        mod.apply()
+        merged = sp.concatenate([self.sts_ev[1], self.sts_ev[3]])
+        mod.update({1: merged, 3: None})
+        self.assertEqual(mod.status, 'finalised')
+        mod_fresh = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            {0: self.sts_ev[0], 1: merged},
+            sys.stdout)
+        mod_fresh.apply()
+        self.assertEqual(mod.sts_ev.keys(), mod_fresh.sts_ev.keys())
+        for i in [0, 1, 2, 6, 9, 10, 11, 12, 13, 14, 15, 16, 17]:
+            self.assertTrue(
+                (sp.asarray(mod.result[i].value) ==
+                 sp.asarray(mod_fresh.result[i].value)).all())
+
+    def test_metric_alignment_sweep(self):
+        mod = ModMetricFranke(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_ev,
+            sys.stdout)
+        tables = mod.sweep([2, 6], [10, 45])
+        self.assertEqual(sorted(tables.keys()),
+                         [(2, 10), (2, 45), (6, 10), (6, 45)])
+        for (jitter, oldist), table in tables.items():
+            mod_single = ModMetricFranke(
+                self.raw_data,
+                dict(self.sts_gt),
+                dict(self.sts_ev),
+                sys.stdout,
+                maxjitter=jitter,
+                maxoverlapdistance=oldist)
+            mod_single.apply()
+            self.assertTrue(
+                (sp.asarray(table.value) ==
+                 sp.asarray(mod_single.result[0].value)).all())
+
+    def test_metric_alignment_chunked(self):
+        mod = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            dict(self.sts_ev),
+            sys.stdout)
+        mod.apply()
+        label_file = StringIO()
+        mod_chunked = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            dict(self.sts_ev),
+            sys.stdout,
+            chunk_size=250,
+            label_file=label_file)
+        mod_chunked.apply()
+        self.assertEqual(mod_chunked.status, 'finalised')
+        for i in [0, 6, 9, 10, 11, 12, 13, 14, 15]:
+            self.assertTrue(
+                (sp.asarray(mod.result[i].value) ==
+                 sp.asarray(mod_chunked.result[i].value)).all())
+        lines = label_file.getvalue().splitlines()
+        self.assertEqual(len(lines), 2 * 23)
+        self.assertTrue('GT\t1\t120\tTPO' in lines)
+
+    def test_metric_alignment_outputs(self):
+        mod = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            dict(self.sts_ev),
+            sys.stdout)
+        mod.apply()
+        mod_table = ModMetricFranke(
+            self.raw_data,
+            dict(self.sts_gt),
+            dict(self.sts_ev),
+            sys.stdout,
+            outputs=['res_table', 'similarity_matrix'])
+        mod_table.apply()
+        self.assertEqual(mod_table.status, 'finalised')
+        for i in [0, 1]:
+            self.assertTrue(
+                (sp.asarray(mod.result[i].value) ==
+                 sp.asarray(mod_table.result[i].value)).all())
+        for i in [4, 5, 7, 8, 9]:
+            self.assertTrue(mod_table.result[i] is None)
+        self.assertRaises(ModuleInputError, ModMetricFranke, self.raw_data,
+                          self.sts_gt, self.sts_ev, sys.stdout,
+                          outputs=['res_tabel'])
+
+    def test_metric_vi(self):
+        mod = ModMetricMeila(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_gt,
+            sys.stdout)
+        mod.apply()
+        self.assertEqual(mod.status, 'finalised')
+        self.assertAlmostEqual(mod.result[0].value, 0.0)
+        mod = ModMetricMeila(
+            self.raw_data,
+            self.sts_gt,
+            self.sts_ev,
+            sys.stdout,
+            maxjitter=2)
+        mod.apply()
+        self.assertTrue(mod.result[0].value > 0.0)
+
+    def test_metric_vi_confmx(self):
+        confmx = ModMetricMeila.confmx(
+            {0: [10, 20, 30], 1: [15]}, {0: [11, 31, 50], 1: [14, 21]}, 2)
+        self.assertTrue((confmx == [[2, 1, 0], [0, 1, 0], [1, 0, 0]]).all())
+        confmx_sparse = ModMetricMeila.confmx(
+            {0: [10, 20, 30], 1: [15]}, {0: [11, 31, 50], 1: [14, 21]}, 2,
+            use_sparse=True)
+        self.assertTrue((confmx == confmx_sparse.toarray()).all())
+        self.assertAlmostEqual(ModMetricMeila.vi_metric(confmx)['VI'],
+                               ModMetricMeila.vi_metric(confmx_sparse)['VI'])
+
 ##---MAIN
 
 if __name__ == '__main__':
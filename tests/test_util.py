@@ -37,6 +37,51 @@ class TestUtil(unittest.TestCase):
         inp = dict_arrsort(inp)
         self.assertTrue(all(sp.diff(inp[0]) >= 0))
 
+    def test_expand_ranges(self):
+        owner, idx = expand_ranges([2, 5, 0], [4, 5, 1])
+        self.assertEqual(owner.tolist(), [0, 0, 2])
+        self.assertEqual(idx.tolist(), [2, 3, 0])
+
+    def test_unit_arrays(self):
+        ua = UnitArrays(['a', 'b', 'c'], [0, 2, 2, 5], sp.arange(5))
+        self.assertEqual(ua.keys(), ['a', 'b', 'c'])
+        self.assertEqual(ua['a'].tolist(), [0, 1])
+        self.assertEqual(ua['b'].tolist(), [])
+        self.assertEqual(ua['c'].tolist(), [2, 3, 4])
+        self.assertEqual(ua.units.tolist(), [0, 0, 2, 2, 2])
+        self.assertTrue(ua['c'].base is not None)
+        self.assertRaises(KeyError, ua.__getitem__, 'd')
+
+    def test_spike_train_set(self):
+        sts = SpikeTrainSet({'a': [30, 10, 20], 'b': sp.array([15.0]),
+                             'c': []})
+        self.assertEqual(sts.data.dtype, sp.int64)
+        self.assertEqual(sorted(sts.keys()), ['a', 'b', 'c'])
+        self.assertEqual(sts['a'].tolist(), [10, 20, 30])
+        self.assertEqual(sts['c'].size, 0)
+        times, units = sts.merged()
+        self.assertEqual(times.tolist(), [10, 15, 20, 30])
+        self.assertEqual(
+            [sts.keys()[u] for u in units.tolist()], ['a', 'b', 'a', 'a'])
+        shifted = sts.shifted(sp.ones(3) * 2)
+        self.assertEqual(shifted.data.dtype, sp.int64)
+        self.assertEqual(shifted['b'].tolist(), [17])
+        self.assertEqual(dict(sts.items())['a'].tolist(), [10, 20, 30])
+        sts = SpikeTrainSet({0: [1.5, 0.5]})
+        self.assertEqual(sts.data.dtype, sp.float64)
+        self.assertEqual(sts[0].tolist(), [0.5, 1.5])
+
+    def test_pair_alignment(self):
+        aligned = {(1, 0): (sp.array([3, 4]), sp.array([0, 2])),
+                   (0, 1): (sp.array([7]), sp.array([5]))}
+        pa = PairAlignment.from_aligned(['g0', 'g1'], ['e0', 'e1'], aligned)
+        self.assertEqual(len(pa), 4)
+        self.assertEqual(pa.pairs.tolist(), [[0, 1], [1, 0]])
+        self.assertEqual(pa.idx1.dtype, sp.int32)
+        self.assertEqual(pa[('g1', 'e0')], [(3, 0), (4, 2)])
+        self.assertEqual(pa[('g0', 'e0')], [])
+        self.assertEqual(dict(pa)[('g0', 'e1')], [(7, 5)])
+
     def test_extract_spikes(self):
         inp = sp.randn(1000, 2)
         eps = sp.array([[10, 20], [50, 60]])
@@ -45,6 +90,37 @@ class TestUtil(unittest.TestCase):
         out = extract_spikes(inp, eps)
         self.assertTrue((out == 0).all())
 
+    def test_extract_spikes_edges(self):
+        inp = sp.arange(20.0).reshape(10, 2)
+        eps = sp.array([[-2, 2], [3, 7], [8, 12]])
+        out = sp.empty((3, 8))
+        self.assertTrue(extract_spikes(inp, eps, out=out, batch_size=2) is out)
+        self.assertTrue((out[0] == [0, 0, 0, 2, 0, 0, 1, 3]).all())
+        self.assertTrue((out[1] == [6, 8, 10, 12, 7, 9, 11, 13]).all())
+        self.assertTrue((out[2] == [16, 18, 0, 0, 17, 19, 0, 0]).all())
+
+    def test_raw_data(self):
+        class ArrayRawData(RawData):
+            def __init__(self, data):
+                super(ArrayRawData, self).__init__(data.shape)
+                self.data = data
+
+            def _read(self, start, stop, channels):
+                return self.data[start:stop, channels]
+
+        inp = sp.randn(100, 3)
+        raw_data = ArrayRawData(inp)
+        inp = inp.astype(sp.float32)
+        self.assertTrue((raw_data[10:20, [0, 2]] == inp[10:20, [0, 2]]).all())
+        self.assertTrue((raw_data[-1] == inp[-1]).all())
+        self.assertTrue((sp.asarray(raw_data) == inp).all())
+        eps = sp.array([[50, 60], [-5, 5], [95, 105], [52, 62], [10, 20]])
+        self.assertTrue(
+            (extract_spikes(raw_data, eps) == extract_spikes(inp, eps)).all())
+        self.assertTrue(
+            (extract_spikes(raw_data, eps, block_size=12) ==
+             extract_spikes(inp, eps)).all())
+
     def test_jitter_st(self):
         start, end, jitter = 0, 100000, 5
         st_init = sp.random.randint(start, end, 20)
@@ -73,6 +149,16 @@ class TestUtil(unittest.TestCase):
         M = sp.array([[1, 2], [3, 4]])
         self.assertEqual((0, 0), matrix_argmin(M))
 
+    def test_ranked_pairs(self):
+        M = sp.array([[1, 3, 0], [3, 2, 1]])
+        self.assertEqual(ranked_pairs(M).tolist(),
+                         [[0, 1], [1, 0], [1, 1], [0, 0], [1, 2], [0, 2]])
+        M = sp.random.randint(0, 5, (6, 7)).astype(float)
+        S = M.copy()
+        for i, j in ranked_pairs(M):
+            self.assertEqual((i, j), matrix_argmax(S))
+            S[i, j] = -1
+
     def test_sortrows(self):
         dim = 100, 3
         data = sp.random.randint(0, 100, dim[0] * dim[1]).reshape(*dim)